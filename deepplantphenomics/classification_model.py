@@ -16,6 +16,7 @@ class ClassificationModel(DPPModel):
                                 definitions.AugmentationType.CROP,
                                 definitions.AugmentationType.CONTRAST_BRIGHT,
                                 definitions.AugmentationType.ROTATE]
+    _supports_input_patching = True
 
     def __init__(self, debug=False, load_from_saved=False, save_checkpoints=True, initialize=True, tensorboard_dir=None,
                  report_rate=100, save_dir=None):
@@ -40,6 +41,26 @@ class ClassificationModel(DPPModel):
 
         self._graph_ops['merged'] = tf.summary.merge_all(key='custom_summaries')
 
+    def _graph_parse_data(self):
+        # The labels are loaded one-hot, but the graph only needs their class indices. Converting them once here means
+        # the input pipelines carry a single int32 per image and no batch needs an argmax over its labels.
+        self._raw_labels = self.__class_indices(self._raw_labels)
+        self._raw_train_labels = self.__class_indices(self._raw_train_labels)
+        self._raw_test_labels = self.__class_indices(self._raw_test_labels)
+        self._raw_val_labels = self.__class_indices(self._raw_val_labels)
+        super()._graph_parse_data()
+
+    def __class_indices(self, labels):
+        """
+        Converts one-hot labels into int32 class indices. Anything else (such as labels that were already converted) is
+        returned as is.
+        :param labels: A 2D array of one-hot labels
+        :return: A 1D array with the class index for each label
+        """
+        if isinstance(labels, np.ndarray) and labels.ndim == 2:
+            return np.argmax(labels, axis=1).astype(np.int32)
+        return labels
+
     def _assemble_graph(self):
         with self._graph.as_default():
             self._log('Assembling graph...')
@@ -50,23 +71,20 @@ class ClassificationModel(DPPModel):
                 self._graph_parse_data()
 
                 # Batch the datasets and create iterators for them
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, drop_remainder=True)
                 if self._testing:
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
                     val_iter = self._batch_and_iterate(self._val_dataset)
 
                 if self._has_moderation:
-                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features)
+                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features,
+                                                             drop_remainder=True)
                     if self._testing:
                         test_mod_iter = self._batch_and_iterate(self._test_moderation_features)
                     if self._validation:
                         val_mod_iter = self._batch_and_iterate(self._val_moderation_features)
 
-                # # If we are using patching, we extract a random patch from the image here
-                # if self._with_patching:
-                #     x, offsets = self._graph_extract_patch(x)
-
             # Create an optimizer object for all of the devices
             optimizer = self._graph_make_optimizer()
 
@@ -97,8 +115,8 @@ class ClassificationModel(DPPModel):
                     # Define the cost function, then get the cost for this device's sub-batch and any parts of the cost
                     # needed to get the overall batch's cost later
                     pred_loss = self._graph_problem_loss(xx, y)
-                    gpu_cost = tf.reduce_mean(tf.concat([pred_loss], axis=0)) + l2_cost
-                    cost_sum = tf.reduce_sum(tf.concat([pred_loss], axis=0))
+                    gpu_cost = tf.reduce_mean(pred_loss) + l2_cost
+                    cost_sum = tf.reduce_sum(pred_loss)
                     device_costs.append(cost_sum)
 
                     # For classification, we need the training accuracy as well so we can report it in Tensorboard
@@ -120,13 +138,6 @@ class ClassificationModel(DPPModel):
             self._graph_ops['cost'] = tf.reduce_sum(device_costs) / self._batch_size + l2_cost
             self._graph_ops['accuracy'] = tf.reduce_sum(device_accuracies) / self._batch_size
 
-            # # If using patching, we need to properly pull similar patches from the test and validation images
-            # if self._with_patching:
-            #     if self._testing:
-            #         x_test, _ = self._graph_extract_patch(x_test, offsets)
-            #     if self._validation:
-            #         x_val, _ = self._graph_extract_patch(x_val, offsets)
-
             if self._testing:
                 x_test, self._graph_ops['y_test'] = test_iter.get_next()
 
@@ -160,36 +171,38 @@ class ClassificationModel(DPPModel):
                 self._graph_tensorboard_summary(l2_cost, average_gradients, opt_variables, global_grad_norm)
 
     def _graph_problem_loss(self, pred, lab):
+        """
+        Calculates the loss for each item in a batch
+        :param pred: Model class predictions (logits) for the batch
+        :param lab: The correct class index for each item in the batch
+        :return: Loss values for each item in a batch
+        """
         if self._loss_fn == 'softmax cross entropy':
-            lab_idx = tf.argmax(lab, axis=1)
-            return tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=lab_idx)
+            return tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=lab)
 
         raise RuntimeError("Could not calculate problem loss for a loss function of " + self._loss_fn)
 
     def _graph_compare_predictions(self, pred, lab):
         """
         Compares the prediction and label classification for each item in a batch, returning
-        :param pred: Model class predictions for the batch; no softmax should be applied to it yet
-        :param lab: Labels for the correct class, with the same shape as pred
+        :param pred: Model class predictions (logits) for the batch; no softmax should be applied to it
+        :param lab: The correct class index for each item in the batch
         :return: 2 Tensors: one with the simplified class predictions (i.e. as a single number), and one with integer
         flags (i.e. 1's and 0's) for whether predictions are correct
         """
-        pred_idx = tf.argmax(tf.nn.softmax(pred), axis=1)
-        lab_idx = tf.argmax(lab, axis=1)
-        is_correct = tf.equal(pred_idx, lab_idx)
+        # Softmax preserves the ordering of the logits, so the predicted class can be read off of them directly
+        pred_idx = tf.argmax(pred, axis=1, output_type=tf.int32)
+        is_correct = tf.equal(pred_idx, lab)
         return pred_idx, is_correct
 
     def _training_batch_results(self, batch_num, start_time, tqdm_range, train_writer=None):
         elapsed = time.time() - start_time
 
-        if train_writer is not None:
-            summary = self._session.run(self._graph_ops['merged'])
-            train_writer.add_summary(summary, batch_num)
-
         if self._validation:
-            loss, epoch_accuracy, epoch_val_accuracy = self._session.run([self._graph_ops['cost'],
-                                                                          self._graph_ops['accuracy'],
-                                                                          self._graph_ops['val_accuracy']])
+            loss, epoch_accuracy, epoch_val_accuracy = self._run_report_ops([self._graph_ops['cost'],
+                                                                             self._graph_ops['accuracy'],
+                                                                             self._graph_ops['val_accuracy']],
+                                                                            batch_num, train_writer)
             samples_per_sec = self._batch_size / elapsed
 
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
@@ -201,10 +214,10 @@ class ClassificationModel(DPPModel):
                                 loss,
                                 epoch_accuracy,
                                 epoch_val_accuracy,
-                                samples_per_sec))
+                                samples_per_sec), refresh=False)
         else:
-            loss, epoch_accuracy = self._session.run([self._graph_ops['cost'],
-                                                      self._graph_ops['accuracy']])
+            loss, epoch_accuracy = self._run_report_ops([self._graph_ops['cost'], self._graph_ops['accuracy']],
+                                                        batch_num, train_writer)
             samples_per_sec = self._batch_size / elapsed
 
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
@@ -215,7 +228,7 @@ class ClassificationModel(DPPModel):
                                 batch_num / (self._total_training_samples / self._batch_size),
                                 loss,
                                 epoch_accuracy,
-                                samples_per_sec))
+                                samples_per_sec), refresh=False)
 
     def compute_full_test_accuracy(self):
         self._log('Computing total test accuracy/regression loss...')
@@ -224,8 +237,7 @@ class ClassificationModel(DPPModel):
             num_batches = int(np.ceil(self._total_testing_samples / self._batch_size))
 
             if num_batches == 0:
-                warnings.warn('Less than a batch of testing data')
-                exit()
+                raise RuntimeError('Less than a batch of testing data')
 
             # Initialize storage for the retrieved test variables
             loss_sum = 0.0
@@ -248,7 +260,7 @@ class ClassificationModel(DPPModel):
                 num_batches += 1
 
             self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
+            im_data = self._all_images.batch(self._batch_size).prefetch(tf.data.experimental.AUTOTUNE)
             x_test = im_data.make_one_shot_iterator().get_next()
 
             if self._load_from_saved:
@@ -302,7 +314,7 @@ class ClassificationModel(DPPModel):
         else:
             num_out = output_size
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.fullyConnectedLayer('output', copy.deepcopy(self._last_layer().output_size), num_out,
                                                reshape, None, self._weight_initializer, regularization_coefficient)
 
@@ -313,26 +325,22 @@ class ClassificationModel(DPPModel):
         """Loads the png images in the given directory, using subdirectories to separate classes."""
 
         # Load all file names and labels into arrays
-        subdirs = list(filter(lambda item: os.path.isdir(item) & (item != '.DS_Store'),
-                              [os.path.join(dirname, f) for f in os.listdir(dirname)]))
+        subdirs = [entry.path for entry in os.scandir(dirname) if entry.is_dir()]
 
         num_classes = len(subdirs)
 
         image_files = []
-        labels = np.array([])
+        class_counts = []
 
         for sd in subdirs:
-            image_paths = [os.path.join(sd, name) for name in os.listdir(sd) if
-                           os.path.isfile(os.path.join(sd, name)) & name.endswith('.png')]
-            image_files = image_files + image_paths
+            image_paths = [entry.path for entry in os.scandir(sd) if
+                           entry.name.endswith('.png') and entry.is_file()]
+            image_files.extend(image_paths)
+            class_counts.append(len(image_paths))
 
-            # for one-hot labels
-            current_labels = np.zeros((num_classes, len(image_paths)))
-            current_labels[self._total_classes, :] = 1
-            labels = np.hstack([labels, current_labels]) if labels.size else current_labels
-            self._total_classes += 1
-
-        labels = tf.transpose(labels)
+        # One-hot labels, with each subdirectory's images being a contiguous run of the same class
+        labels = np.eye(num_classes, dtype=np.float32)[np.repeat(np.arange(num_classes), class_counts)]
+        self._total_classes = num_classes
 
         self._total_raw_samples = len(image_files)
 
@@ -362,12 +370,9 @@ class ClassificationModel(DPPModel):
 
         self._total_raw_samples = len(image_files)
 
-        self._total_classes = len(set(labels))
-
         # transform into numerical one-hot labels
-        with self._graph.as_default():
-            labels = loaders.string_labels_to_sequential(labels)
-            labels = tf.one_hot(labels, self._total_classes)
+        labels, self._total_classes = loaders.string_labels_to_sequential(labels, return_num_classes=True)
+        labels = np.eye(self._total_classes, dtype=np.float32)[labels]
 
         self._log('Total classes is %d' % self._total_classes)
         self._log('Total raw examples is %d' % self._total_raw_samples)
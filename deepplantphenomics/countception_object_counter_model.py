@@ -4,7 +4,6 @@ import tensorflow.compat.v1 as tf
 import datetime
 import time
 import os
-import warnings
 from tqdm import tqdm
 import pickle
 
@@ -41,7 +40,7 @@ class CountCeptionModel(DPPModel):
                 self._graph_parse_data()
 
                 # Batch the datasets and create iterators for them
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, drop_remainder=True)
                 if self._testing:
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
@@ -153,14 +152,11 @@ class CountCeptionModel(DPPModel):
     def _training_batch_results(self, batch_num, start_time, tqdm_range, train_writer=None):
         elapsed = time.time() - start_time
 
-        if train_writer is not None:
-            summary = self._session.run(self._graph_ops['merged'])
-            train_writer.add_summary(summary, batch_num)
-
         if self._validation:
-            loss, epoch_accuracy, epoch_val_accuracy = self._session.run([self._graph_ops['cost'],
-                                                                          self._graph_ops['accuracy'],
-                                                                          self._graph_ops['val_accuracy']])
+            loss, epoch_accuracy, epoch_val_accuracy = self._run_report_ops([self._graph_ops['cost'],
+                                                                             self._graph_ops['accuracy'],
+                                                                             self._graph_ops['val_accuracy']],
+                                                                            batch_num, train_writer)
             samples_per_sec = self._batch_size / elapsed
 
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
@@ -172,11 +168,11 @@ class CountCeptionModel(DPPModel):
                                 loss,
                                 epoch_accuracy,
                                 epoch_val_accuracy,
-                                samples_per_sec))
+                                samples_per_sec), refresh=False)
 
         else:
-            loss, epoch_accuracy = self._session.run([self._graph_ops['cost'],
-                                                      self._graph_ops['accuracy']])
+            loss, epoch_accuracy = self._run_report_ops([self._graph_ops['cost'], self._graph_ops['accuracy']],
+                                                        batch_num, train_writer)
             samples_per_sec = self._batch_size / elapsed
 
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
@@ -187,7 +183,7 @@ class CountCeptionModel(DPPModel):
                                 batch_num / (self._total_training_samples / self._batch_size),
                                 loss,
                                 epoch_accuracy,
-                                samples_per_sec))
+                                samples_per_sec), refresh=False)
 
     def compute_full_test_accuracy(self):
         self._log('Computing total test accuracy...')
@@ -196,8 +192,7 @@ class CountCeptionModel(DPPModel):
             num_batches = int(np.ceil(self._total_testing_samples / self._batch_size))
 
             if num_batches == 0:
-                warnings.warn('Less than a batch of testing data')
-                exit()
+                raise RuntimeError('Less than a batch of testing data')
 
             # Initialize storage for the retrieved test variables
             loss_sum = 0.0
@@ -229,7 +224,7 @@ class CountCeptionModel(DPPModel):
         with self._graph.as_default():
             self._parse_images(x)
 
-            dataset_batch = self._all_images.batch(self._batch_size).prefetch(self._batch_size * 2)
+            dataset_batch = self._all_images.batch(self._batch_size).prefetch(tf.data.experimental.AUTOTUNE)
             iterator = dataset_batch.make_one_shot_iterator()
             image_data = iterator.get_next()
 
@@ -266,9 +261,10 @@ class CountCeptionModel(DPPModel):
         # With Countception, we can have either strings from an inference forward pass, or straight arrays from a
         # pickle file during training.
         if images.dtype == tf.string:
-            images = super()._parse_read_images(images, channels)
+            images = super()._parse_read_images(images, channels, image_type)
         else:
-            images = tf.image.convert_image_dtype(images, dtype=image_type)
+            # The pickled images are already decoded to floats, so they're kept that way instead of being narrowed
+            images = tf.image.convert_image_dtype(images, dtype=tf.float32)
         return images
 
     def load_countception_dataset_from_pkl_file(self, pkl_file_name):
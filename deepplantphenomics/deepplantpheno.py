@@ -3,14 +3,17 @@ import numpy as np
 import tensorflow.compat.v1 as tf
 import tensorflow.contrib
 from tensorflow.python.client import device_lib
+from tensorflow.core.protobuf import rewriter_config_pb2
 import os
-import json
 import datetime
 import time
 import warnings
 import copy
 import math
 import random
+import contextlib
+import collections
+import concurrent.futures
 from abc import ABC, abstractmethod
 from tqdm import tqdm
 
@@ -23,7 +26,14 @@ class DPPModel(ABC):
     """
     # Class variables with the supported implementations for various network components; subclasses should override
     # these
-    _supported_optimizers = ['adam', 'adagrad', 'adadelta', 'sgd', 'sgd_momentum']
+    _optimizer_factories = {'adam': ('Adam', tf.train.AdamOptimizer),
+                            'adagrad': ('Adagrad', tf.train.AdagradOptimizer),
+                            'adadelta': ('Adadelta', tf.train.AdadeltaOptimizer),
+                            'sgd': ('SGD', tf.train.GradientDescentOptimizer),
+                            'sgd_momentum': ('SGD with momentum',
+                                             lambda lr: tf.train.MomentumOptimizer(lr, 0.9, use_nesterov=True))}
+    _supported_optimizers = list(_optimizer_factories)
+    _supported_gradient_clipping = ['global norm', 'value']
     _supported_weight_initializers = ['normal', 'xavier']
     _supported_activation_functions = ['relu', 'tanh', 'lrelu', 'selu']
     _supported_pooling_types = ['max', 'avg']
@@ -37,6 +47,7 @@ class DPPModel(ABC):
                                 definitions.AugmentationType.CONTRAST_BRIGHT,
                                 definitions.AugmentationType.ROTATE]
     _supports_standardization = True
+    _supports_input_patching = False
 
     def __init__(self, debug=False, load_from_saved=False, save_checkpoints=True, initialize=True, tensorboard_dir=None,
                  report_rate=100, save_dir=None):
@@ -134,7 +145,9 @@ class DPPModel(ABC):
         self._session = None
         self._graph = None
         self._graph_ops = {}
+        self._saver = None
         self._layers = []
+        self._l2_cost = 0.0
         self._global_epoch = 0
 
         self._num_layers_norm = 0
@@ -156,8 +169,11 @@ class DPPModel(ABC):
         self._maximum_training_batches = None
         self._reg_coeff = None
         self._optimizer = 'adam'
+        self._gradient_clipping = 'global norm'
+        self._summarize_gradients = False
         self._weight_initializer = 'xavier'
         self._loss_fn = None
+        self._random_seed = None
 
         self._learning_rate = 0.001
         self._lr_decay_factor = None
@@ -175,6 +191,10 @@ class DPPModel(ABC):
         self._num_gpus = 1
         self._max_gpus = 1  # Set this properly below
         self._subbatch_size = self._batch_size
+        self._mixed_precision = False
+        self._xla_compilation = False
+        self._cache_decoded_images = False
+        self._cache_evaluation_images = False
 
         # Now do actual initialization stuff
         # Add the run level to the tensorboard path
@@ -195,6 +215,39 @@ class DPPModel(ABC):
         if self._debug:
             print('{0}: {1}'.format(datetime.datetime.now().strftime("%I:%M%p"), message))
 
+    def _submit_bounded(self, pool, jobs, fn, *args, **kwargs):
+        """
+        Submits a job to a thread pool, first waiting on the oldest pending jobs while there are more than twice as many
+        as there are threads. A queued job keeps its arguments (like image patches) in memory until it runs, so this
+        stops them piling up when jobs are submitted faster than they finish.
+        :param pool: The `concurrent.futures.Executor` to run the job on
+        :param jobs: A deque of the pending jobs' futures, which the new job's future is appended to
+        :param fn: The callable to run, followed by its arguments
+        """
+        while len(jobs) >= 2 * self._num_threads:
+            jobs.popleft().result()
+        jobs.append(pool.submit(fn, *args, **kwargs))
+
+    @contextlib.contextmanager
+    def _autopatch_png_saver(self):
+        """
+        Returns a context for saving patches as PNGs while the next patches are being extracted. Encoding a PNG releases
+        the GIL, so the saves run on a thread pool, and only a few are let queue up at a time (see `_submit_bounded`) so
+        that finished patches don't pile up in memory. The PNGs use the lowest zlib compression level, which is still
+        lossless but several times faster than the default. Every save has finished when the context exits, and any
+        errors from writing the patches are raised then.
+        :return: A function taking a PIL image and its filename, which queues the image to be saved
+        """
+        jobs = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads) as pool:
+            def save(image, filename):
+                self._submit_bounded(pool, jobs, image.save, filename, compress_level=1)
+
+            yield save
+
+            for job in jobs:
+                job.result()
+
     def _last_layer(self):
         return self._layers[-1]
 
@@ -205,12 +258,48 @@ class DPPModel(ABC):
         return next(layer for layer in self._layers if
                     isinstance(layer, layers.convLayer) or isinstance(layer, layers.fullyConnectedLayer))
 
+    def _session_config(self):
+        """Returns the config for the model's session, which is where graph-wide options like XLA and mixed precision
+        get turned on"""
+        config = tf.ConfigProto(allow_soft_placement=True)
+        if self._xla_compilation:
+            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        if self._mixed_precision:
+            # The float16 compute comes from this Grappler rewrite; the optimizer wrapper from
+            # enable_mixed_precision_graph_rewrite only adds loss scaling, since it turns the rewrite on just for
+            # sessions created after it and the model's session already exists by then
+            config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+        return config
+
     def _reset_session(self):
-        self._session = tf.Session(graph=self._graph,
-                                   config=tf.ConfigProto(allow_soft_placement=True))
+        self._session = tf.Session(graph=self._graph, config=self._session_config())
 
     def _reset_graph(self):
         self._graph = tf.Graph()
+        self._saver = None
+
+    def _get_saver(self):
+        """Returns the saver for the model's variables, creating it on first use. A new saver for every checkpoint would
+        add its save and restore ops to the graph each time, and the session has to extend its copy of the graph before
+        the next training step whenever the graph grows."""
+        if self._saver is None:
+            with self._graph_context():
+                self._saver = tf.train.Saver(tf.global_variables())
+        return self._saver
+
+    def _graph_context(self):
+        """Returns a context for adding ops to the model's graph, which is a no-op if that graph is already the default
+        (i.e. when building a predefined model) to avoid re-entering it for every layer"""
+        if tf.get_default_graph() is self._graph:
+            return contextlib.ExitStack()
+        return self._graph.as_default()
+
+    def _graph_jit_scope(self):
+        """Returns a context that marks the ops created in it for XLA compilation on any device, which is a no-op
+        unless XLA compilation is turned on"""
+        if self._xla_compilation:
+            return tf.xla.experimental.jit_scope()
+        return contextlib.ExitStack()
 
     def set_number_of_threads(self, num_threads):
         """Set number of threads for preprocessing tasks"""
@@ -241,6 +330,49 @@ class DPPModel(ABC):
             raise RuntimeError("{0} GPUs can't evenly distribute a batch size of {1}"
                                .format(self._num_gpus, self._batch_size))
 
+    def set_mixed_precision(self, mixed_precision):
+        """Train with mixed float16/float32 precision, which lets convolutions run on the Tensor Cores of recent GPUs.
+        Tensorflow decides which ops are safe to run in float16 and applies loss scaling to keep small gradients from
+        underflowing. This has no effect when training on a CPU. This recreates the session, so it should be set before
+        training or loading a model."""
+        if not isinstance(mixed_precision, bool):
+            raise TypeError("mixed_precision must be a bool")
+
+        self._mixed_precision = mixed_precision
+        if self._session is not None:
+            self._session.close()
+            self._reset_session()
+
+    def set_xla_compilation(self, xla_compilation):
+        """Compile the model's graph with XLA, which fuses chains of ops (like convolution, batch norm, and activation)
+        into fewer kernels. The input shapes are fixed, so the graph only needs to be compiled once. This recreates the
+        session, so it should be set before training or loading a model."""
+        if not isinstance(xla_compilation, bool):
+            raise TypeError("xla_compilation must be a bool")
+
+        self._xla_compilation = xla_compilation
+        if self._session is not None:
+            self._session.close()
+            self._reset_session()
+
+    def set_cache_decoded_images(self, cache_decoded_images):
+        """Keep input images in memory after they are first decoded (and resized), so that only the first epoch pays
+        for reading and decoding them. Augmentations are still applied fresh each epoch, while testing and validation
+        images are kept fully preprocessed. The whole decoded dataset has to fit in memory for this."""
+        if not isinstance(cache_decoded_images, bool):
+            raise TypeError("cache_decoded_images must be a bool")
+
+        self._cache_decoded_images = cache_decoded_images
+
+    def set_cache_evaluation_images(self, cache_evaluation_images):
+        """Keep only the fully preprocessed testing and validation images in memory, so that repeated validation and
+        the final test don't read and decode them again. Training images are read from disk each epoch as usual. This
+        is implied by set_cache_decoded_images and only needs the testing and validation sets to fit in memory."""
+        if not isinstance(cache_evaluation_images, bool):
+            raise TypeError("cache_evaluation_images must be a bool")
+
+        self._cache_evaluation_images = cache_evaluation_images
+
     def set_random_seed(self, seed):
         """
         Sets a random seed for any random operations used during augmentation and training. This is used to help
@@ -250,6 +382,7 @@ class DPPModel(ABC):
         if not isinstance(seed, int):
             raise TypeError("seed must be an int")
 
+        self._random_seed = seed
         random.seed(seed)
         np.random.seed(seed)
         with self._graph.as_default():
@@ -438,6 +571,28 @@ class DPPModel(ABC):
 
         self._optimizer = optimizer
 
+    def set_gradient_clipping(self, clip_mode):
+        """Set how gradients are clipped during training. 'global norm' (the default) rescales all of the gradients
+        together so their combined norm is at most 5. 'value' clips each gradient element to [-5, 5] on its own, which
+        skips the reduction over every gradient needed to get the global norm."""
+        if not isinstance(clip_mode, str):
+            raise TypeError("clip_mode must be a str")
+        clip_mode = clip_mode.lower()
+        if clip_mode not in self._supported_gradient_clipping:
+            raise ValueError("'" + clip_mode + "' is not one of the currently supported gradient clipping modes. " +
+                             "Choose one of " + " ".join("'" + x + "'" for x in self._supported_gradient_clipping))
+
+        self._gradient_clipping = clip_mode
+
+    def set_gradient_summaries(self, summarize_gradients):
+        """Add histograms of every gradient (and their global norm) to the Tensorboard summaries. These are off by
+        default, since computing them means a backward pass on every report step on top of the forward passes needed
+        for the other summaries."""
+        if not isinstance(summarize_gradients, bool):
+            raise TypeError("summarize_gradients must be a bool")
+
+        self._summarize_gradients = summarize_gradients
+
     def set_loss_function(self, loss_fn):
         """Set the loss function to use"""
         if not isinstance(loss_fn, str):
@@ -553,6 +708,15 @@ class DPPModel(ABC):
                 with tf.device(d):
                     layer.add_to_graph()
 
+        # The weight decay only depends on the layer weights, so it's built once here and shared by every graph tower
+        self._l2_cost = 0.0
+        if self._reg_coeff is not None:
+            with tf.device(d):
+                l2_terms = [layer.regularization_coefficient * tf.nn.l2_loss(layer.weights) for layer in self._layers
+                            if isinstance(layer, layers.fullyConnectedLayer)]
+                if l2_terms:
+                    self._l2_cost = tf.add_n(l2_terms)
+
     def _graph_parse_data(self):
         """
         Add graph components that parse the input images and labels into tensors and split them into training,
@@ -580,46 +744,34 @@ class DPPModel(ABC):
                                 test_images, test_labels, test_mf,
                                 val_images, val_labels, val_mf)
 
-    def _graph_extract_patch(self, x, offsets=None):
-        """
-        Adds graph components to extract patches from input images
-        :param x: Tensor, an image to extract a patch from
-        :param offsets: An optional list of (height, width) tuples for where to extract patches from in the images. When
-        this isn't given, offsets will be generated at random and returned
-        :return: The extracted image patches and the offsets used to get them
-        """
-        if not offsets:
-            offset_h = np.random.randint(self._patch_height // 2,
-                                         self._image_height - (self._patch_height // 2),
-                                         self._batch_size)
-            offset_w = np.random.randint(self._patch_width // 2,
-                                         self._image_width - (self._patch_width // 2),
-                                         self._batch_size)
-            offsets = [x for x in zip(offset_h, offset_w)]
-        x = tf.image.extract_glimpse(x, [self._patch_height, self._patch_width], offsets,
-                                     normalized=False, centered=False)
-        return x, offsets
+    def _graph_tile_patches(self, x, num_patch_rows, num_patch_cols):
+        """
+        Adds graph components to split images into tightly tiled, non-overlapping patches of the patch size
+        :param x: Tensor, a batch of images that are exactly num_patch_rows patches tall and num_patch_cols patches wide
+        :param num_patch_rows: The number of rows of patches in each image
+        :param num_patch_cols: The number of columns of patches in each image
+        :return: A Tensor with the patches, ordered by image, then by patch row, then by patch column
+        """
+        # The patches tile the images exactly, so they can be cut out by reshaping and transposing alone. This is
+        # cheaper than extract_image_patches and keeps the static patch shape.
+        x = tf.reshape(x, [-1, num_patch_rows, self._patch_height,
+                           num_patch_cols, self._patch_width, self._image_depth])
+        x = tf.transpose(x, [0, 1, 3, 2, 4, 5])
+        return tf.reshape(x, [-1, self._patch_height, self._patch_width, self._image_depth])
 
     def _graph_make_optimizer(self):
         """Generate a new optimizer object for computing and applying gradients"""
-        if self._optimizer == 'adagrad':
-            self._log('Using Adagrad optimizer')
-            return tf.train.AdagradOptimizer(self._learning_rate)
-        elif self._optimizer == 'adadelta':
-            self._log('Using Adadelta optimizer')
-            return tf.train.AdadeltaOptimizer(self._learning_rate)
-        elif self._optimizer == 'sgd':
-            self._log('Using SGD optimizer')
-            return tf.train.GradientDescentOptimizer(self._learning_rate)
-        elif self._optimizer == 'adam':
-            self._log('Using Adam optimizer')
-            return tf.train.AdamOptimizer(self._learning_rate)
-        elif self._optimizer == 'sgd_momentum':
-            self._log('Using SGD with momentum optimizer')
-            return tf.train.MomentumOptimizer(self._learning_rate, 0.9, use_nesterov=True)
-        else:
-            warnings.warn('Unrecognized optimizer requested')
-            exit()
+        if self._optimizer not in self._optimizer_factories:
+            raise ValueError("'" + str(self._optimizer) + "' is not one of the currently supported optimizers")
+        optimizer_name, make_optimizer = self._optimizer_factories[self._optimizer]
+        self._log('Using ' + optimizer_name + ' optimizer')
+        optimizer = make_optimizer(self._learning_rate)
+
+        if self._mixed_precision:
+            self._log('Using mixed precision training')
+            optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer)
+
+        return optimizer
 
     def _graph_get_gradients(self, loss, optimizer):
         """
@@ -628,8 +780,16 @@ class DPPModel(ABC):
         :param optimizer: The optimizer object used to generate the gradients
         :return: The graph's gradients, variables, and the global gradient norm from clipping
         """
-        gradients, variables = zip(*optimizer.compute_gradients(loss))
-        gradients, global_grad_norm = tf.clip_by_global_norm(gradients, 5.0)
+        # The session's XLA setting only auto-clusters ops placed on GPUs, so the backward pass and clipping are also
+        # marked for compilation explicitly. They're the longest chain of small elementwise ops in a training step.
+        with self._graph_jit_scope():
+            gradients, variables = zip(*optimizer.compute_gradients(loss))
+            if self._gradient_clipping == 'value':
+                # The norm is only for Tensorboard, so training steps that don't fetch the summaries never compute it
+                global_grad_norm = tf.global_norm(gradients)
+                gradients = [tf.clip_by_value(g, -5.0, 5.0) if g is not None else None for g in gradients]
+            else:
+                gradients, global_grad_norm = tf.clip_by_global_norm(gradients, 5.0)
         return gradients, variables, global_grad_norm
 
     def _graph_average_gradients(self, graph_gradients):
@@ -660,17 +820,14 @@ class DPPModel(ABC):
         :param optimizer: The optimizer object used to apply the gradients
         :return: An operation for applying gradients to the graph variables
         """
-        return optimizer.apply_gradients(zip(gradients, variables), global_step=self._lr_epoch)
+        # Any ops registered as updates (like moving averages for batch norm) run as part of every training step
+        with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            return optimizer.apply_gradients(zip(gradients, variables), global_step=self._lr_epoch)
 
     def _graph_layer_loss(self):
-        """Calculates and returns the total L2 loss from the weights of fully connected layers. This is 0 if a
-        regularization coefficient isn't specified."""
-        if self._reg_coeff is not None:
-            return tf.squeeze(tf.reduce_sum(
-                [layer.regularization_coefficient * tf.nn.l2_loss(layer.weights) for layer in self._layers
-                 if isinstance(layer, layers.fullyConnectedLayer)]))
-        else:
-            return 0.0
+        """Returns the total L2 loss from the weights of fully connected layers, as built by _add_layers_to_graph. This
+        is 0 if a regularization coefficient isn't specified."""
+        return self._l2_cost
 
     @abstractmethod
     def _graph_problem_loss(self, pred, lab):
@@ -715,27 +872,38 @@ class DPPModel(ABC):
                                  collections=['custom_summaries'])
 
         # Summaries for each net_layer
-        for layer in self._layers:
-            if hasattr(layer, 'name'):
-                if isinstance(layer, layers.paralConvBlock):
-                    _add_layer_histograms(layer.conv1)
-                    _add_layer_histograms(layer.conv2)
-                elif not isinstance(layer, layers.batchNormLayer) and not isinstance(layer, layers.copyConnection) \
-                        and not isinstance(layer, layers.skipConnection):
-                    _add_layer_histograms(layer)
+        for layer in self._summary_layers():
+            _add_layer_histograms(layer)
 
         # Summaries for gradients
         # We use variables[index].name[:-2] because variables[index].name will have a ':0' at the end of
         # the name and tensorboard does not like this so we remove it with the [:-2]
         # We also currently seem to get None's for gradients when performing a hyper-parameter search
         # and as such it is simply left out for hyper-param searches, needs to be fixed
-        if not self._hyper_param_search:
+        if self._summarize_gradients and not self._hyper_param_search:
             for index, grad in enumerate(gradients):
                 tf.summary.histogram("gradients/" + variables[index].name[:-2], gradients[index],
                                      collections=['custom_summaries'])
 
             tf.summary.histogram("gradient_global_norm/", global_grad_norm, collections=['custom_summaries'])
 
+    def _summary_layers(self):
+        """
+        Lists the layers that get weight, bias, and activation histograms in Tensorboard. Layers without weights of
+        their own are left out, and parallel convolution blocks are replaced by the two convolutions inside them.
+        :return: A list of the layers to summarize
+        """
+        summary_layers = []
+        for layer in self._layers:
+            if not hasattr(layer, 'name') or \
+                    isinstance(layer, (layers.batchNormLayer, layers.copyConnection, layers.skipConnection)):
+                continue
+            if isinstance(layer, layers.paralConvBlock):
+                summary_layers.extend([layer.conv1, layer.conv2])
+            else:
+                summary_layers.append(layer)
+        return summary_layers
+
     def _graph_tensorboard_summary(self, l2_cost, gradients, variables, global_grad_norm):
         """
         Adds graph components related to outputting losses and other summary variables to Tensorboard.
@@ -757,26 +925,47 @@ class DPPModel(ABC):
         """
         pass
 
-    def _batch_and_iterate(self, dataset, shuffle=False):
+    def _batch_and_iterate(self, dataset, drop_remainder=False):
         """
-        Sets up batching and prefetching for a Dataset, with optional shuffling (for training), and returns an iterator
-        for the final Dataset.
+        Sets up batching and prefetching for a Dataset and returns an iterator for the final Dataset. Datasets from
+        _make_input_dataset are already shuffled for training and don't need shuffling here.
         :param dataset: The Dataset to prepare with batching and prefetching
-        :param shuffle: A flag for whether to shuffle the Dataset items
+        :param drop_remainder: A flag for whether every batch should be full. The Dataset is repeated before batching,
+        so batches run across epoch boundaries and have a static batch size. Use this for training only, since testing
+        and validation rely on the last partial batch to cover each sample exactly once.
         :return: A one-shot iterator for the prepared Dataset
         """
-        if shuffle:
-            dataset = dataset.shuffle(10000)
-        dataset = dataset.batch(self._subbatch_size)
-        dataset = dataset.repeat()
-        dataset = dataset.prefetch(self._num_gpus)
+        if drop_remainder:
+            dataset = dataset.repeat()
+            dataset = dataset.batch(self._subbatch_size, drop_remainder=True)
+        else:
+            dataset = dataset.batch(self._subbatch_size)
+            dataset = dataset.repeat()
+        # Let Tensorflow tune the prefetch buffer so that image decoding and augmentation overlap with training
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
         data_iter = dataset.make_one_shot_iterator()
         return data_iter
 
+    def _run_report_ops(self, report_ops, batch_num, train_writer=None):
+        """
+        Runs the ops reported on mid-training in a single session call, fetching the Tensorboard summaries in the same
+        call when there's a writer for them so that they come from the same batches
+        :param report_ops: A list of the graph ops to report on
+        :param batch_num: The batch number for the mid-training results
+        :param train_writer: A `tf.summary.FileWriter` for writing Tensorboard log files
+        :return: A list with the values of the ops in report_ops
+        """
+        if train_writer is None:
+            return self._session.run(report_ops)
+
+        *report_values, summary = self._session.run(report_ops + [self._graph_ops['merged']])
+        train_writer.add_summary(summary, batch_num)
+        return report_values
+
     def _training_batch_results(self, batch_num, start_time, tqdm_range, train_writer=None):
         """
         Calculates and reports mid-training losses and other statistics, both through the console and through writing
-        Tensorboard log files
+        Tensorboard log files. The console description is redrawn on tqdm's own rate limit rather than on every report.
         :param batch_num: The batch number for the mid-training results
         :param start_time: The start time to use for calculating the processing rate
         :param tqdm_range: A `tqdm` object for displaying training results to the console
@@ -784,12 +973,9 @@ class DPPModel(ABC):
         """
         elapsed = time.time() - start_time
 
-        if train_writer is not None:
-            summary = self._session.run(self._graph_ops['merged'])
-            train_writer.add_summary(summary, batch_num)
-
         if self._validation:
-            loss, epoch_test_loss = self._session.run([self._graph_ops['cost'], self._graph_ops['val_cost']])
+            loss, epoch_test_loss = self._run_report_ops([self._graph_ops['cost'], self._graph_ops['val_cost']],
+                                                         batch_num, train_writer)
             samples_per_sec = self._batch_size / elapsed
 
             desc_str = "{}: Results for batch {} (epoch {:.1f}) - Loss: {}, Validation Loss: {}, samples/sec: {:.2f}"
@@ -799,9 +985,9 @@ class DPPModel(ABC):
                                 batch_num / (self._total_training_samples / self._batch_size),
                                 loss,
                                 epoch_test_loss,
-                                samples_per_sec))
+                                samples_per_sec), refresh=False)
         else:
-            loss = self._session.run([self._graph_ops['cost']])
+            loss, = self._run_report_ops([self._graph_ops['cost']], batch_num, train_writer)
             samples_per_sec = self._batch_size / elapsed
 
             desc_str = "{}: Results for batch {} (epoch {:.1f}) - Loss: {}, samples/sec: {:.2f}"
@@ -810,7 +996,7 @@ class DPPModel(ABC):
                                 batch_num,
                                 batch_num / (self._total_training_samples / self._batch_size),
                                 loss,
-                                samples_per_sec))
+                                samples_per_sec), refresh=False)
 
     def begin_training(self, return_test_loss=False):
         """
@@ -840,21 +1026,21 @@ class DPPModel(ABC):
 
                 self._log('Beginning training...')
 
-                # Needed for batch norm
-                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-                self._graph_ops['optimizer'] = tf.group([self._graph_ops['optimizer'], update_ops])
-
-                # Weight decay
-                if False:
-                    decay_ops = [l.decay_weights() for l in self._layers if callable(getattr(l, 'decay_weights', None))]
+                # A callable for the training step validates and sets up its fetches once, rather than on every
+                # session.run, which cuts the Python overhead paid on each step
+                train_step = self._session.make_callable([self._graph_ops['optimizer'], self._graph_ops['cost']])
 
                 tqdm_range = tqdm(range(self._maximum_training_batches))
                 for i in tqdm_range:
                     start_time = time.time()
                     self._global_epoch = i
-                    self._session.run(self._graph_ops['optimizer'])
+                    report_step = self._global_epoch > 0 and self._global_epoch % self._report_rate == 0
 
-                    if self._global_epoch > 0 and self._global_epoch % self._report_rate == 0:
+                    # The loss comes out of the same run as the training step, so it is for the batch just trained on
+                    # and doesn't need another batch and forward pass
+                    _, loss = train_step()
+
+                    if report_step:
                         if self._tb_dir is not None:
                             self._training_batch_results(i, start_time, tqdm_range, train_writer)
                         else:
@@ -862,11 +1048,6 @@ class DPPModel(ABC):
 
                         if self._save_checkpoints and self._global_epoch % (self._report_rate * 100) == 0:
                             self.save_state(self._save_dir)
-                    else:
-                        loss = self._session.run([self._graph_ops['cost']])
-
-                        if False:
-                            self._session.run(decay_ops)
 
                     if loss == 0.0:
                         self._log('Stopping due to zero loss')
@@ -1035,9 +1216,7 @@ class DPPModel(ABC):
         if not os.path.isdir(state_dir):
             os.mkdir(state_dir)
 
-        with self._graph.as_default():
-            saver = tf.train.Saver(tf.global_variables())
-            saver.save(self._session, state_dir + '/tfhSaved')
+        self._get_saver().save(self._session, state_dir + '/tfhSaved')
 
         self._has_trained = True
 
@@ -1052,14 +1231,57 @@ class DPPModel(ABC):
         if self._load_from_saved is not False:
             self._log('Loading from checkpoint file...')
 
-            with self._graph.as_default():
-                saver = tf.train.Saver(tf.global_variables())
-                saver.restore(self._session, tf.train.latest_checkpoint(self._load_from_saved))
+            self._get_saver().restore(self._session, tf.train.latest_checkpoint(self._load_from_saved))
 
             self._has_trained = True
         else:
-            warnings.warn('Tried to load state with no file given. Make sure load_from_saved is set in constructor.')
-            exit()
+            raise RuntimeError('Tried to load state with no file given. Make sure load_from_saved is set in ' +
+                               'constructor.')
+
+    def export_quantized_model(self, filename, calibration_images):
+        """
+        Exports the trained network as a Tensorflow Lite model with its weights and activations quantized to 8-bit
+        integers, giving a smaller model with faster inference on CPUs and mobile devices. The network's activation
+        ranges are calibrated by running it over a sample of images. Ops without an 8-bit kernel, like those in the
+        input standardization at the start of the network, are kept in float.
+
+        :param filename: The path of the .tflite file to write the quantized model to
+        :param calibration_images: An ndarray of images of shape [num_images, height, width, depth] that are
+        representative of what the exported model will see. These should be raw float images with values in [0, 1],
+        resized or cropped to the network's input size but not standardized, since the network standardizes its inputs
+        itself
+        """
+        if not isinstance(filename, str):
+            raise TypeError("filename must be a str")
+        if not isinstance(calibration_images, np.ndarray):
+            raise TypeError("calibration_images must be an ndarray")
+        if calibration_images.ndim != 4 or calibration_images.shape[0] == 0:
+            raise ValueError("calibration_images must have a shape of [num_images, height, width, depth]")
+
+        self._log('Exporting quantized model...')
+        calibration_images = calibration_images.astype(np.float32)
+
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis, ...]]
+
+        with self._graph.as_default():
+            x = tf.placeholder(tf.float32, shape=(1,) + calibration_images.shape[1:])
+
+            if self._load_from_saved:
+                self.load_state()
+            y = self.forward_pass(x, deterministic=True)
+
+            converter = tf.lite.TFLiteConverter.from_session(self._session, [x], [y])
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+            # The standardization at the start of the network (moments, rsqrt, maximum) has no int8-only kernels in
+            # Tensorflow Lite, so float builtins are allowed as a fallback for it rather than failing the conversion
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+            quantized_model = converter.convert()
+
+        with open(filename, 'wb') as f:
+            f.write(quantized_model)
 
     def _set_learning_rate(self):
         if self._lr_decay_factor is not None:
@@ -1071,21 +1293,32 @@ class DPPModel(ABC):
                                                              self._lr_decay_factor,
                                                              staircase=True)
 
-    def forward_pass(self, x, deterministic=False, moderation_features=None):
+    def forward_pass(self, x, deterministic=False, moderation_features=None, standardize=True):
         """
         Perform a forward pass of the network with an input tensor. In general, this is only used when the model is
         integrated into a Tensorflow graph. See forward_pass_with_file_inputs for a version that returns network
         outputs detached from a graph.
 
+        For models that standardize their inputs, each input image is standardized to zero mean and unit variance as
+        the first step of the forward pass, so x should be a batch of raw float images with values in [0, 1]. Pass
+        standardize=False to feed in images that have already been standardized (or inputs that shouldn't be).
+
         :param x: input tensor where the first dimension is batch
         :param deterministic: if True, performs inference-time operations on stochastic layers e.g. DropOut layers
         :param moderation_features: ???
+        :param standardize: if False, the inputs are taken as already standardized, e.g. when they are patches of
+        whole images that were standardized before being split up. If True, x has to be a batch of images with shape
+        [batch, height, width, depth].
         :return: output tensor where the first dimension is batch
         """
         residual = None
         copy_stack = []
 
         with self._graph.as_default():
+            # Mean-center all inputs
+            if self._supports_standardization and standardize:
+                x = self._graph_standardize_images(x)
+
             for layer in self._layers:
                 if isinstance(layer, layers.skipConnection):
                     # The first skip only sends its residual value down to later layers. Further skips have to receive
@@ -1107,6 +1340,25 @@ class DPPModel(ABC):
 
         return x
 
+    def _graph_standardize_images(self, x):
+        """
+        Standardizes each image in a batch to zero mean and unit variance, like tf.image.per_image_standardization.
+        This is done on whole batches at the start of the network, rather than image by image in the input pipeline,
+        so that it runs on the same device as the first layers and can be fused with them.
+        :param x: A batch of images with shape [batch, height, width, depth]
+        :return: The standardized images
+        """
+        x = tf.convert_to_tensor(x)
+        if x.shape.ndims != 4:
+            raise ValueError("Images to standardize must be a batch with shape [batch, height, width, depth], but got "
+                             "a tensor of shape " + str(x.shape))
+
+        num_pixels = tf.cast(tf.reduce_prod(tf.shape(x)[1:]), x.dtype)
+        mean, variance = tf.nn.moments(x, axes=[1, 2, 3], keepdims=True)
+        # Like per_image_standardization, keep the scale from blowing up for (nearly) uniform images
+        adjusted_stddev = tf.maximum(tf.sqrt(variance), tf.rsqrt(num_pixels))
+        return (x - mean) / adjusted_stddev
+
     @abstractmethod
     def forward_pass_with_file_inputs(self, x):
         """
@@ -1148,7 +1400,7 @@ class DPPModel(ABC):
         if self._with_patching:
             size = [self._subbatch_size, self._patch_height, self._patch_width, self._image_depth]
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.inputLayer(size)
 
         self._layers.append(layer)
@@ -1161,7 +1413,7 @@ class DPPModel(ABC):
 
         feat_size = self._moderation_features_size
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.moderationLayer(copy.deepcopy(self._last_layer().output_size),
                                            feat_size, reshape, self._subbatch_size)
 
@@ -1229,7 +1481,7 @@ class DPPModel(ABC):
         layer_name = 'conv%d' % self._num_layers_conv
         self._log('Adding convolutional layer %s...' % layer_name)
 
-        with self._graph.as_default():
+        with self._graph_context():
             filter_dimension[2] = self._last_layer().output_size[-1]
             layer = layers.convLayer(layer_name,
                                      copy.deepcopy(self._last_layer().output_size),
@@ -1276,7 +1528,7 @@ class DPPModel(ABC):
             batch_multiplier = 1
 
         last_layer_dims = copy.deepcopy(self._last_layer().output_size)
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.upsampleLayer(layer_name,
                                          last_layer_dims,
                                          filter_size,
@@ -1323,7 +1575,7 @@ class DPPModel(ABC):
         layer_name = 'pool%d' % self._num_layers_pool
         self._log('Adding pooling layer %s...' % layer_name)
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.poolingLayer(copy.deepcopy(
                 self._last_layer().output_size), kernel_size, stride_length, pooling_type)
 
@@ -1341,7 +1593,7 @@ class DPPModel(ABC):
         layer_name = 'norm%d' % self._num_layers_pool
         self._log('Adding pooling layer %s...' % layer_name)
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.normLayer(copy.deepcopy(self._last_layer().output_size))
 
         self._layers.append(layer)
@@ -1364,7 +1616,7 @@ class DPPModel(ABC):
         layer_name = 'drop%d' % self._num_layers_dropout
         self._log('Adding dropout layer %s...' % layer_name)
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.dropoutLayer(copy.deepcopy(self._last_layer().output_size), p)
 
         self._layers.append(layer)
@@ -1378,7 +1630,7 @@ class DPPModel(ABC):
         layer_name = 'bn%d' % self._num_layers_batchnorm
         self._log('Adding batch norm layer %s...' % layer_name)
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.batchNormLayer(layer_name, copy.deepcopy(self._last_layer().output_size))
 
         self._layers.append(layer)
@@ -1425,7 +1677,7 @@ class DPPModel(ABC):
         if regularization_coefficient is None and self._reg_coeff is None:
             regularization_coefficient = 0.0
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.fullyConnectedLayer(layer_name, copy.deepcopy(self._last_layer().output_size), output_size,
                                                reshape, activation_function, self._weight_initializer,
                                                regularization_coefficient)
@@ -1466,7 +1718,7 @@ class DPPModel(ABC):
         block_name = 'paral_conv_block%d' % self._num_blocks_paral_conv
         self._log('Adding parallel convolutional block %s...' % block_name)
 
-        with self._graph.as_default():
+        with self._graph_context():
             block = layers.paralConvBlock(block_name,
                                           copy.deepcopy(self._last_layer().output_size),
                                           filter_dimension_1,
@@ -1544,6 +1796,12 @@ class DPPModel(ABC):
                              "first, or choose one of " +
                              " ".join("'" + x + "'" for x in self._supported_predefined_models))
 
+        # Enter the graph once for the whole model rather than once per layer
+        with self._graph.as_default():
+            self.__add_predefined_model_layers(model_name)
+
+    def __add_predefined_model_layers(self, model_name):
+        """Adds the layers for one of the supported predefined models"""
         if model_name == 'u-net':
             bn = False
 
@@ -1645,28 +1903,12 @@ class DPPModel(ABC):
         if model_name == 'vgg-16':
             self.add_input_layer()
 
-            self.add_convolutional_layer(filter_dimension=[3, 3, self._image_depth, 64],
-                                         stride_length=1, activation_function='relu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 64], stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 128], stride_length=1, activation_function='relu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 128], stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 256], stride_length=1, activation_function='relu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 256], stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 512], stride_length=1, activation_function='relu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1, activation_function='relu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1, activation_function='relu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1, activation_function='relu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
+            self.__add_conv_stack([[3, 3, 64], [3, 3, 64], 'pool',
+                                   [3, 3, 128], [3, 3, 128], 'pool',
+                                   [3, 3, 256], [3, 3, 256], 'pool',
+                                   [3, 3, 512], [3, 3, 512], [3, 3, 512], 'pool',
+                                   [3, 3, 512], [3, 3, 512], [3, 3, 512], 'pool'],
+                                  activation_function='relu')
 
             self.add_fully_connected_layer(output_size=4096, activation_function='relu')
             self.add_dropout_layer(0.5)
@@ -1760,15 +2002,10 @@ class DPPModel(ABC):
         if model_name == 'xsmall':
             self.add_input_layer()
 
-            self.add_convolutional_layer(filter_dimension=[3, 3, self._image_depth, 16],
-                                         stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 16, 32], stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 32, 32], stride_length=1, activation_function='relu')
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
+            self.__add_conv_stack([[3, 3, 16], 'pool',
+                                   [3, 3, 32], 'pool',
+                                   [3, 3, 32], 'pool'],
+                                  activation_function='relu')
 
             self.add_fully_connected_layer(output_size=64, activation_function='relu')
 
@@ -1777,21 +2014,10 @@ class DPPModel(ABC):
         if model_name == 'small':
             self.add_input_layer()
 
-            self.add_convolutional_layer(filter_dimension=[3, 3, self._image_depth, 64],
-                                         stride_length=1, activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
+            self.__add_conv_stack([[3, 3, 64], 'pool',
+                                   [3, 3, 128], [3, 3, 128], 'pool',
+                                   [3, 3, 128], [3, 3, 128], 'pool'],
+                                  activation_function='relu', batch_norm=True)
 
             self.add_fully_connected_layer(output_size=64, activation_function='relu')
 
@@ -1800,39 +2026,12 @@ class DPPModel(ABC):
         if model_name == 'medium':
             self.add_input_layer()
 
-            self.add_convolutional_layer(filter_dimension=[3, 3, self._image_depth, 64],
-                                         stride_length=1, activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 64], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 256], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 256], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
+            self.__add_conv_stack([[3, 3, 64], [3, 3, 64], 'pool',
+                                   [3, 3, 128], [3, 3, 128], 'pool',
+                                   [3, 3, 256], [3, 3, 256], 'pool',
+                                   [3, 3, 512], [3, 3, 512], [3, 3, 512], 'pool',
+                                   [3, 3, 512], [3, 3, 512], [3, 3, 512], 'pool'],
+                                  activation_function='relu', batch_norm=True)
 
             self.add_fully_connected_layer(output_size=256, activation_function='relu')
 
@@ -1841,39 +2040,12 @@ class DPPModel(ABC):
         if model_name == 'large':
             self.add_input_layer()
 
-            self.add_convolutional_layer(filter_dimension=[3, 3, self._image_depth, 64], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 64], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 128], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 256], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 256], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 512], stride_length=1,
-                                         activation_function='relu', batch_norm=True)
-            self.add_pooling_layer(kernel_size=2, stride_length=2)
+            self.__add_conv_stack([[3, 3, 64], [3, 3, 64], 'pool',
+                                   [3, 3, 128], [3, 3, 128], 'pool',
+                                   [3, 3, 256], [3, 3, 256], 'pool',
+                                   [3, 3, 512], [3, 3, 512], [3, 3, 512], 'pool',
+                                   [3, 3, 512], [3, 3, 512], [3, 3, 512], 'pool'],
+                                  activation_function='relu', batch_norm=True)
 
             self.add_fully_connected_layer(output_size=512, activation_function='relu')
             self.add_fully_connected_layer(output_size=384, activation_function='relu')
@@ -1883,56 +2055,14 @@ class DPPModel(ABC):
         if model_name == 'yolov2':
             self.add_input_layer()
 
-            self.add_convolutional_layer(filter_dimension=[3, 3, self._image_depth, 32],  stride_length=1,
-                                         activation_function='lrelu')
-            self.add_pooling_layer(kernel_size=3, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 32, 64], stride_length=1, activation_function='lrelu')
-            self.add_pooling_layer(kernel_size=3, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 128], stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[1, 1, 128, 64], stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 64, 128], stride_length=1, activation_function='lrelu')
-            self.add_pooling_layer(kernel_size=3, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 256],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[1, 1, 256, 128],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 128, 256],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_pooling_layer(kernel_size=3, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 512],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[1, 1, 512, 256],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 512],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[1, 1, 512, 256],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 256, 512],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_pooling_layer(kernel_size=3, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 1024],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[1, 1, 1024, 512],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 1024],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[1, 1, 1024, 512],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 512, 1024],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_pooling_layer(kernel_size=3, stride_length=2)
-
-            self.add_convolutional_layer(filter_dimension=[3, 3, 1024, 1024],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 1024, 1024],
-                                         stride_length=1, activation_function='lrelu')
-            self.add_convolutional_layer(filter_dimension=[3, 3, 1024, 1024],
-                                         stride_length=1, activation_function='lrelu')
+            self.__add_conv_stack([[3, 3, 32], 'pool',
+                                   [3, 3, 64], 'pool',
+                                   [3, 3, 128], [1, 1, 64], [3, 3, 128], 'pool',
+                                   [3, 3, 256], [1, 1, 128], [3, 3, 256], 'pool',
+                                   [3, 3, 512], [1, 1, 256], [3, 3, 512], [1, 1, 256], [3, 3, 512], 'pool',
+                                   [3, 3, 1024], [1, 1, 512], [3, 3, 1024], [1, 1, 512], [3, 3, 1024], 'pool']
+                                  + [[3, 3, 1024]] * 3,
+                                  activation_function='lrelu', pool_size=3)
 
             self.add_output_layer()
 
@@ -1994,6 +2124,26 @@ class DPPModel(ABC):
                                          epsilon=1e-5,
                                          decay=0.9)
 
+    def __add_conv_stack(self, stack, activation_function, batch_norm=False, pool_size=2):
+        """
+        Adds a VGG/Darknet-style stack of stride 1 convolutional layers and max pooling layers to the model
+        :param stack: List of layers to add in order, where each one is either a [filter_height, filter_width,
+        num_filters] list for a convolutional layer or 'pool' for a pooling layer with a stride of 2. Layers are only
+        read, so repeated layers can share one list (e.g. [[3, 3, 1024]] * 3)
+        :param activation_function: The activation function for the convolutional layers
+        :param batch_norm: Whether the convolutional layers should include a batch norm layer
+        :param pool_size: The kernel size of the pooling layers
+        """
+        for layer in stack:
+            if layer == 'pool':
+                self.add_pooling_layer(kernel_size=pool_size, stride_length=2)
+            else:
+                # The filter depth is filled in from the previous layer when the convolutional layer is added
+                filter_height, filter_width, num_filters = layer
+                self.add_convolutional_layer(filter_dimension=[filter_height, filter_width, 0, num_filters],
+                                             stride_length=1, activation_function=activation_function,
+                                             batch_norm=batch_norm)
+
     def load_dataset_from_directory_with_csv_labels(self, dirname, labels_file, column_number=False):
         """
         Loads the png images in the given directory into an internal representation, using the labels provided in a CSV
@@ -2010,8 +2160,8 @@ class DPPModel(ABC):
         if not isinstance(labels_file, str):
             raise TypeError("labels_file must be a str")
 
-        image_files = [os.path.join(dirname, name) for name in os.listdir(dirname) if
-                       os.path.isfile(os.path.join(dirname, name)) & name.endswith('.png')]
+        image_files = [entry.path for entry in os.scandir(dirname) if
+                       entry.name.endswith('.png') and entry.is_file()]
 
         labels = loaders.read_csv_labels(labels_file, column_number)
 
@@ -2032,21 +2182,18 @@ class DPPModel(ABC):
         """
         self._resize_bbox_coords = True
 
-        images = [os.path.join(dirname, name) for name in sorted(os.listdir(dirname)) if
-                  os.path.isfile(os.path.join(dirname, name)) & name.endswith('_rgb.png')]
+        images = sorted([entry.path for entry in os.scandir(dirname) if
+                          entry.name.endswith('_rgb.png') and entry.is_file()])
 
-        label_files = [os.path.join(dirname, name) for name in sorted(os.listdir(dirname)) if
-                       os.path.isfile(os.path.join(dirname, name)) & name.endswith('_bbox.csv')]
+        label_files = sorted([entry.path for entry in os.scandir(dirname) if
+                               entry.name.endswith('_bbox.csv') and entry.is_file()])
 
         # currently reads columns, need to read rows instead!!!
         labels = [loaders.read_csv_rows(label_file) for label_file in label_files]
 
-        self._all_labels = []
-        for label in labels:
-            curr_label = []
-            for nums in label:
-                curr_label.extend(loaders.box_coordinates_to_pascal_voc_coordinates(nums))
-            self._all_labels.append(curr_label)
+        self._all_labels = [[coord for nums in label
+                             for coord in loaders.box_coordinates_to_pascal_voc_coordinates(nums)]
+                            for label in labels]
 
         self._total_raw_samples = len(images)
 
@@ -2092,11 +2239,10 @@ class DPPModel(ABC):
         image_files = [os.path.join(dirname, im_id) for im_id in ids]
 
         self._total_raw_samples = len(image_files)
-        self._total_classes = len(set(labels))
 
         # transform into numerical one-hot labels
-        labels = loaders.string_labels_to_sequential(labels)
-        labels = tf.one_hot(labels, self._total_classes)
+        labels, self._total_classes = loaders.string_labels_to_sequential(labels, return_num_classes=True)
+        labels = np.eye(self._total_classes, dtype=np.float32)[labels]
 
         self._log('Total raw examples is %d' % self._total_raw_samples)
         self._log('Total classes is %d' % self._total_classes)
@@ -2118,19 +2264,16 @@ class DPPModel(ABC):
         train_labels, train_images = loaders.read_csv_labels_and_ids(os.path.join(train_dir, 'train.txt'), 1, 0,
                                                                      character=' ')
 
-        def one_hot(labels, num_classes):
-            return [[1 if i == label else 0 for i in range(num_classes)] for label in labels]
+        one_hot = np.eye(self._total_classes, dtype=np.float32)
 
         # transform into numerical one-hot labels
-        train_labels = [int(label) for label in train_labels]
-        train_labels = one_hot(train_labels, self._total_classes)
+        train_labels = one_hot[[int(label) for label in train_labels]]
 
         test_labels, test_images = loaders.read_csv_labels_and_ids(os.path.join(test_dir, 'test.txt'), 1, 0,
                                                                    character=' ')
 
         # transform into numerical one-hot labels
-        test_labels = [int(label) for label in test_labels]
-        test_labels = one_hot(test_labels, self._total_classes)
+        test_labels = one_hot[[int(label) for label in test_labels]]
 
         self._total_raw_samples = len(train_images) + len(test_images)
         self._test_split = len(test_images) / self._total_raw_samples
@@ -2145,7 +2288,7 @@ class DPPModel(ABC):
         if not self._testing:
             self._raw_train_image_files.extend(self._raw_test_image_files)
             self._raw_test_image_files = []
-            self._raw_train_labels.extend(self._raw_test_labels)
+            self._raw_train_labels = np.concatenate([self._raw_train_labels, self._raw_test_labels])
             self._raw_test_labels = []
             self._test_split = 0
         if self._validation:
@@ -2162,26 +2305,18 @@ class DPPModel(ABC):
         """
 
         # Load all snapshot subdirectories
-        subdirs = list(filter(lambda item: os.path.isdir(item) & (item != '.DS_Store'),
-                              [os.path.join(dirname, f) for f in os.listdir(dirname)]))
+        subdirs = [entry.path for entry in os.scandir(dirname) if entry.is_dir()]
 
         image_files = []
 
         # Load the VIS images in each subdirectory
         for sd in subdirs:
-            image_paths = [os.path.join(sd, name) for name in os.listdir(sd) if
-                           os.path.isfile(os.path.join(sd, name)) & name.startswith('VIS_SV_')]
-
-            image_files = image_files + image_paths
+            image_files.extend([entry.path for entry in os.scandir(sd) if
+                                entry.name.startswith('VIS_SV_') and entry.is_file()])
 
         # Put the image files in the order of the IDs (if there are any labels loaded)
-        sorted_paths = []
-
         if self._all_labels is not None:
-            for image_id in self._all_ids:
-                path = list(filter(lambda item: item.endswith(image_id), [p for p in image_files]))
-                assert len(path) == 1, 'Found no image or multiple images for %r' % image_id
-                sorted_paths.append(path[0])
+            sorted_paths = self.__sort_image_files_by_id(image_files, self._all_ids)
         else:
             sorted_paths = image_files
 
@@ -2229,17 +2364,12 @@ class DPPModel(ABC):
         """Loads images from a directory, relating them to labels by the IDs which were loaded from a CSV file"""
 
         # Load all images in directory
-        image_files = [os.path.join(im_dir, name) for name in os.listdir(im_dir) if
-                       os.path.isfile(os.path.join(im_dir, name)) & name.endswith('.png')]
+        image_files = [entry.path for entry in os.scandir(im_dir) if
+                       entry.name.endswith('.png') and entry.is_file()]
 
         # Put the image files in the order of the IDs (if there are any labels loaded)
-        sorted_paths = []
-
         if self._all_labels is not None:
-            for image_id in self._all_ids:
-                path = list(filter(lambda item: item.endswith('/' + image_id), [p for p in image_files]))
-                assert len(path) == 1, 'Found no image or multiple images for %r' % image_id
-                sorted_paths.append(path[0])
+            sorted_paths = self.__sort_image_files_by_id(image_files, self._all_ids, '/')
         else:
             sorted_paths = image_files
 
@@ -2255,6 +2385,30 @@ class DPPModel(ABC):
             self._raw_image_files = processed_images
             self._raw_labels = self._all_labels
 
+    def __sort_image_files_by_id(self, image_files, ids, id_prefix=''):
+        """
+        Puts image files in the order of the given IDs, where each ID has to match the end of exactly one file path.
+        Files are indexed by name first so that IDs are only compared against files with the same name, and only IDs
+        that are part of a file name need to be checked against every file.
+
+        :param image_files: List of image file paths
+        :param ids: List of image IDs, such as the ones loaded with the labels
+        :param id_prefix: A string that has to come right before each ID in the matching path (e.g. a path separator)
+        :return: The image file paths in the order of the IDs
+        """
+        files_by_name = {}
+        for image_file in image_files:
+            files_by_name.setdefault(os.path.basename(image_file), []).append(image_file)
+
+        sorted_paths = []
+        for image_id in ids:
+            candidates = files_by_name.get(os.path.basename(image_id), image_files)
+            path = [p for p in candidates if p.endswith(id_prefix + image_id)]
+            assert len(path) == 1, 'Found no image or multiple images for %r' % image_id
+            sorted_paths.append(path[0])
+
+        return sorted_paths
+
     def load_training_augmentation_dataset_from_directory_with_csv_labels(self, dirname, labels_file, column_number=1,
                                                                           id_column_number=0):
         """
@@ -2266,17 +2420,12 @@ class DPPModel(ABC):
         :param id_column_number: the column number (zero-indexed) representing the file ID
         """
 
-        image_files = [os.path.join(dirname, name) for name in os.listdir(dirname) if
-                       os.path.isfile(os.path.join(dirname, name)) & name.endswith('.png')]
+        image_files = [entry.path for entry in os.scandir(dirname) if
+                       entry.name.endswith('.png') and entry.is_file()]
 
         labels, ids = loaders.read_csv_labels_and_ids(labels_file, column_number, id_column_number)
 
-        sorted_paths = []
-
-        for image_id in ids:
-            path = list(filter(lambda item: item.endswith('/' + image_id), [p for p in image_files]))
-            assert len(path) == 1, 'Found no image or multiple images for %r' % image_id
-            sorted_paths.append(path[0])
+        sorted_paths = self.__sort_image_files_by_id(image_files, ids, '/')
 
         self._training_augmentation_images = sorted_paths
         self._training_augmentation_labels = labels
@@ -2284,52 +2433,35 @@ class DPPModel(ABC):
     def load_pascal_voc_labels_from_directory(self, data_dir):
         """Loads single per-image bounding boxes from XML files in Pascal VOC format."""
 
-        self._all_ids = []
-        self._all_labels = []
-
-        file_paths = [os.path.join(data_dir, name) for name in os.listdir(data_dir) if
-                      os.path.isfile(os.path.join(data_dir, name)) & name.endswith('.xml')]
+        file_paths = [entry.path for entry in os.scandir(data_dir) if
+                      entry.name.endswith('.xml') and entry.is_file()]
 
-        for voc_file in file_paths:
-            im_id, x_min, x_max, y_min, y_max = loaders.read_single_bounding_box_from_pascal_voc(voc_file)
+        voc_boxes = [loaders.read_single_bounding_box_from_pascal_voc(voc_file) for voc_file in file_paths]
+        self._all_ids = [box[0] for box in voc_boxes]
+        coords = np.reshape(np.array([box[1:] for box in voc_boxes], dtype=np.float64), (-1, 4))
 
-            # re-scale coordinates if images are being resized
-            if self._resize_images:
-                x_min = int(x_min * (float(self._image_width) / self._image_width_original))
-                x_max = int(x_max * (float(self._image_width) / self._image_width_original))
-                y_min = int(y_min * (float(self._image_height) / self._image_height_original))
-                y_max = int(y_max * (float(self._image_height) / self._image_height_original))
+        # re-scale coordinates (x_min, x_max, y_min, y_max) for all of the boxes at once if images are being resized
+        if self._resize_images:
+            width_ratio = float(self._image_width) / self._image_width_original
+            height_ratio = float(self._image_height) / self._image_height_original
+            coords = (coords * [width_ratio, width_ratio, height_ratio, height_ratio]).astype(int)
 
-            self._all_ids.append(im_id)
-            self._all_labels.append([x_min, x_max, y_min, y_max])
+        self._all_labels = coords.tolist()
 
     def load_json_labels_from_file(self, filename):
         """Loads bounding boxes for multiple images from a single json file."""
 
-        self._all_ids = []
+        image_ids, image_sizes, image_boxes = loaders.read_json_bounding_boxes(filename)
+
+        self._all_ids = list(image_ids)  # Names of corresponding images
         self._all_labels = []
+        for (w_original, h_original), boxes in zip(image_sizes, image_boxes):
+            # re-scale coordinates if images are being resized
+            if self._resize_images:
+                scale_w = float(self._image_width) / w_original
+                scale_h = float(self._image_height) / h_original
+                boxes = (boxes * [scale_w, scale_w, scale_h, scale_h]).astype(int)
 
-        with open(filename, 'r', encoding='utf-8-sig') as f:
-            box_data = json.load(f)
-        for box in sorted(box_data.items()):
-            self._all_ids.append(box[0])  # Name of corresponding image
-            w_original = box[1]['width']
-            h_original = box[1]['height']
-            boxes = []
-            for plant in box[1]['plants']:
-                x_min = plant['all_points_x'][0]
-                x_max = plant['all_points_x'][1]
-                y_min = plant['all_points_y'][0]
-                y_max = plant['all_points_y'][1]
-
-                # re-scale coordinates if images are being resized
-                if self._resize_images:
-                    x_min = int(x_min * (float(self._image_width) / w_original))
-                    x_max = int(x_max * (float(self._image_width) / w_original))
-                    y_min = int(y_min * (float(self._image_height) / h_original))
-                    y_max = int(y_max * (float(self._image_height) / h_original))
-
-                boxes.append([x_min, x_max, y_min, y_max])
             self._all_labels.append(boxes)
 
     def _parse_dataset(self, train_images, train_labels, train_mf,
@@ -2350,8 +2482,7 @@ class DPPModel(ABC):
             self._maximum_training_batches = int(self._maximum_training_batches * batches_per_epoch)
 
             if self._batch_size > self._total_training_samples:
-                self._log('Less than one batch in training set, exiting now')
-                exit()
+                raise RuntimeError('Less than one batch in training set')
             self._log('Batches per epoch: {:f}'.format(batches_per_epoch))
             self._log('Running to {0} batches'.format(self._maximum_training_batches))
 
@@ -2393,16 +2524,31 @@ class DPPModel(ABC):
             """Takes a function on images only and appends its labels to the output"""
             return lambda im, lab: (fn(im), lab)
 
+        # Images may be read in as uint8 and are only converted to float once a step needs it; cropping, padding, and
+        # flipping move 4x fewer bytes on uint8 images (as does caching them). This does nothing to float images.
+        to_float = _with_labels(lambda x: tf.image.convert_image_dtype(x, tf.float32))
+
         data_height = self._image_height
         data_width = self._image_width
 
-        # Create the dataset and load in the images
+        # Create the dataset and load in the images. Training data is shuffled while it's still just file names and
+        # labels, so the shuffle buffer doesn't have to hold (and wait on decoding) thousands of full images. A cached
+        # dataset would replay the first epoch's order though, so it has to be shuffled after the cache instead.
         input_dataset = tf.data.Dataset.from_tensor_slices((images, labels))
+        if train_set and not self._cache_decoded_images:
+            input_dataset = input_dataset.shuffle(10000)
         input_dataset = input_dataset.map(self._parse_apply_preprocessing, num_parallel_calls=self._num_threads)
-        if self._resize_images:
+        if self._resize_images:  # Resizing interpolates between pixels, so it has to be done on float images
+            input_dataset = input_dataset.map(to_float, num_parallel_calls=self._num_threads)
             input_dataset = input_dataset.map(lambda x, y: self._parse_resize_images(x, y, data_height, data_width),
                                               num_parallel_calls=self._num_threads)
 
+        # Decoding and resizing are deterministic, so their results can be reused across epochs. Testing and validation
+        # data doesn't get any random augmentations, so it's cached at the end of the pipeline instead.
+        if self._cache_decoded_images and train_set:
+            input_dataset = input_dataset.cache()
+            input_dataset = input_dataset.shuffle(10000)
+
         # Augmentations that we should do to every dataset (training, testing, and validation)
         if self._augmentation_crop:  # Apply random crops to images
             data_height = int(data_height * self._crop_amount)
@@ -2419,6 +2565,22 @@ class DPPModel(ABC):
             input_dataset = input_dataset.map(lambda x, y: self._parse_crop_or_pad(x, y, data_height, data_width),
                                               num_parallel_calls=self._num_threads)
 
+        # Take a patch of each image for models that train on patches of whole images: a random one for training and
+        # the centre one for testing and validation, so the evaluated patches don't depend on the training ones
+        if self._with_patching and self._supports_input_patching:
+            patch_top = (data_height - self._patch_height) // 2
+            patch_left = (data_width - self._patch_width) // 2
+            data_height, data_width = self._patch_height, self._patch_width
+            if train_set:
+                input_dataset = input_dataset.map(
+                    _with_labels(lambda x: tf.random_crop(x, [data_height, data_width, self._image_depth])),
+                    num_parallel_calls=self._num_threads)
+            else:
+                input_dataset = input_dataset.map(
+                    _with_labels(lambda x: tf.image.crop_to_bounding_box(x, patch_top, patch_left,
+                                                                         data_height, data_width)),
+                    num_parallel_calls=self._num_threads)
+
         if train_set:
             # Augmentations that we should only do to the training dataset
             if self._augmentation_flip_horizontal:  # Apply random horizontal flips
@@ -2429,6 +2591,10 @@ class DPPModel(ABC):
                 input_dataset = input_dataset.map(_with_labels(tf.image.random_flip_up_down),
                                                   num_parallel_calls=self._num_threads)
 
+        # Everything past this point (and the model itself) works with float images
+        input_dataset = input_dataset.map(to_float, num_parallel_calls=self._num_threads)
+
+        if train_set:
             if self._augmentation_contrast:  # Apply random contrast and brightness adjustments
                 def contrast_fn(x):
                     x = tf.image.random_brightness(x, max_delta=63)
@@ -2446,17 +2612,32 @@ class DPPModel(ABC):
                         _with_labels(lambda x: self._parse_rotation_crop(x, crop_fraction, data_height, data_width)),
                         num_parallel_calls=self._num_threads)
 
-        # Mean-center all inputs
-        if self._supports_standardization:
-            input_dataset = input_dataset.map(_with_labels(tf.image.per_image_standardization),
-                                              num_parallel_calls=self._num_threads)
-
         # Manually set the shape of the image tensors so it matches the shape of the images
         input_dataset = input_dataset.map(
             lambda x, y: self._parse_force_set_shape(x, y, data_height, data_width, self._image_depth),
             num_parallel_calls=self._num_threads)
 
-        return input_dataset
+        if (self._cache_decoded_images or self._cache_evaluation_images) and not train_set:
+            input_dataset = input_dataset.cache()
+
+        # Training images are shuffled anyway, so their order only matters when a random seed asks for reproducibility
+        return self._fuse_dataset_maps(input_dataset, deterministic=not train_set or self._random_seed is not None)
+
+    def _fuse_dataset_maps(self, dataset, deterministic=True):
+        """
+        Lets Tensorflow fuse consecutive map stages in a Dataset. The preprocessing and augmentation steps are each
+        added as their own map for readability, but fusing them runs them as one function per image, skipping the
+        buffering and hand-off between stages and letting Grappler optimize across the steps.
+        :param dataset: The Dataset to enable map fusion for
+        :param deterministic: A flag for whether the Dataset has to keep its order. Without it, parallel map calls can
+        hand back whichever items finish first instead of stalling behind a slow one.
+        :return: The Dataset with map fusion enabled
+        """
+        options = tf.data.Options()
+        options.experimental_optimization.map_fusion = True
+        if not deterministic:
+            options.experimental_deterministic = False
+        return dataset.with_options(options)
 
     def _parse_images(self, images):
         """
@@ -2464,34 +2645,28 @@ class DPPModel(ABC):
         :param images: A list of image names to parse
         """
         with self._graph.as_default():
-            input_dataset = tf.data.Dataset.from_tensor_slices(images)
-            input_dataset = input_dataset.map(lambda x: self._parse_read_images(x, channels=self._image_depth),
-                                              num_parallel_calls=self._num_threads)
-            input_dataset = input_dataset.map(
-                lambda x: tf.image.resize_images(x, [self._image_height, self._image_width]),
-                num_parallel_calls=self._num_threads)
-
-            if self._augmentation_crop or self._crop_or_pad_images:
-                if self._augmentation_crop:
-                    self._image_height = int(self._image_height * self._crop_amount)
-                    self._image_width = int(self._image_width * self._crop_amount)
-                input_dataset = input_dataset.map(
-                    lambda x: tf.image.resize_image_with_crop_or_pad(x, self._image_height, self._image_width),
-                    num_parallel_calls=self._num_threads)
+            # Inference images get no augmentations, so every step is done in a single map rather than one map (and one
+            # dataset node) per step. The resize uses the full image size while the crop uses the cropped size.
+            resize_height, resize_width = self._image_height, self._image_width
+            crop_images = self._augmentation_crop or self._crop_or_pad_images
+            if self._augmentation_crop:
+                self._image_height = int(self._image_height * self._crop_amount)
+                self._image_width = int(self._image_width * self._crop_amount)
 
-            # Mean-center all inputs
-            if self._supports_standardization:
-                input_dataset = input_dataset.map(tf.image.per_image_standardization,
-                                                  num_parallel_calls=self._num_threads)
+            def parse_image(x):
+                x = self._parse_read_images(x, channels=self._image_depth)
+                x = tf.image.resize_images(x, [resize_height, resize_width])
+                if crop_images:
+                    x = tf.image.resize_image_with_crop_or_pad(x, self._image_height, self._image_width)
 
-            # Manually set the shape of the image tensors so it matches the shape of the images
-            def force_set(x):
+                # Manually set the shape of the image tensors so it matches the shape of the images
                 x.set_shape([self._image_height, self._image_width, self._image_depth])
                 return x
 
-            input_dataset = input_dataset.map(force_set, num_parallel_calls=self._num_threads)
+            input_dataset = tf.data.Dataset.from_tensor_slices(images)
+            input_dataset = input_dataset.map(parse_image, num_parallel_calls=self._num_threads)
 
-            self._all_images = input_dataset
+            self._all_images = self._fuse_dataset_maps(input_dataset)
 
     def _parse_get_sample_counts(self, train_images, test_images, val_images):
         """
@@ -2529,12 +2704,13 @@ class DPPModel(ABC):
 
     def _parse_apply_preprocessing(self, images, labels):
         """
-        Applies input loading and preprocessing to images and labels from a dataset
+        Applies input loading and preprocessing to images and labels from a dataset. Images are left as uint8 here and
+        converted to float later in the input pipeline.
         :param images: Image names to load and preprocess
         :param labels: The accompanying labels; normally passed through unchanged
         :return: The preprocessed versions of the images and the passed-through labels
         """
-        images = self._parse_read_images(images, channels=self._image_depth)
+        images = self._parse_read_images(images, channels=self._image_depth, image_type=tf.uint8)
         return images, labels
 
     def _parse_read_images(self, images, channels=1, image_type=tf.float32):
@@ -2547,12 +2723,11 @@ class DPPModel(ABC):
         (32-bit float images).
         :return: The preprocessed versions of the images
         """
-        # decode_png and decode_jpeg apparently both accept JPEG and PNG. We're using one of them because decode_image
-        # also accepts GIF, preventing the return of a static shape and preventing resize_images from running. See this
-        # Github issue for Tensorflow: https://github.com/tensorflow/tensorflow/issues/9356
+        # decode_image would normally return 4D tensors for animated GIFs, preventing the return of a static rank and
+        # preventing resize_images from running (see https://github.com/tensorflow/tensorflow/issues/9356). Turning off
+        # expand_animations makes it always return one 3D image, and it converts to the desired type while decoding.
         images = tf.io.read_file(images)
-        images = tf.io.decode_png(images, channels=channels)
-        images = tf.image.convert_image_dtype(images, dtype=image_type)
+        images = tf.io.decode_image(images, channels=channels, dtype=image_type, expand_animations=False)
         return images
 
     def _parse_resize_images(self, images, labels, height, width):
@@ -2629,29 +2804,9 @@ class DPPModel(ABC):
         :return: The crop fraction that achieves the smallest area among border-less crops for rotated images
         """
         # Regardless of the aspect ratio, the smallest crop fraction always corresponds to the required crop for a 45
-        # degree or pi/4 radian rotation
-        angle = math.pi / 4
-
-        # Determine which sides of the original image are the shorter and longer sides
-        width_is_longer = width >= height
-        if width_is_longer:
-            (short_length, long_length) = (height, width)
-        else:
-            (short_length, long_length) = (width, height)
-
-        # Get the absolute sin and cos of the angle, since the quadrant doesn't affect us
-        sin_a = abs(math.sin(angle))
-        cos_a = abs(math.cos(angle))
-
-        # There are 2 possible solutions for the width and height in general depending on the angle and aspect ratio,
-        # but 45 degree rotations always fall into the solution below. This corresponds to a rectangle with one corner
-        # at the midpoint of an edge and the other corner along the centre line of the rotated image, although this
-        # cropped rectangle will ultimately be slid up so that it's centered inside the rotated image.
-        x = 0.5 * short_length
-        if width_is_longer:
-            (crop_width, crop_height) = (x / sin_a, x / cos_a)
-        else:
-            (crop_width, crop_height) = (x / cos_a, x / sin_a)
-
-        # Use the crop width and height to calculate the required crop ratio
-        return (crop_width * crop_height) / (width * height)
+        # degree or pi/4 radian rotation. This corresponds to a rectangle with one corner at the midpoint of an edge and
+        # the other corner along the centre line of the rotated image, although this cropped rectangle will ultimately
+        # be slid up so that it's centered inside the rotated image. Its sides are half the shorter image side divided
+        # by sin(pi/4) and cos(pi/4), and since both of those are 1/sqrt(2), the crop area is short_length^2 / 2.
+        short_length = min(height, width)
+        return (short_length * short_length) / (2.0 * width * height)
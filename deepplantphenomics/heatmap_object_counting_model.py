@@ -91,8 +91,7 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
             num_batches = int(np.ceil(self._total_testing_samples / self._batch_size))
 
             if num_batches == 0:
-                warnings.warn('Less than a batch of testing data')
-                exit()
+                raise RuntimeError('Less than a batch of testing data')
 
             # Initialize storage for the retrieved test variables
             all_losses = []
@@ -372,30 +371,33 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
         new_labels = []
         out_labels = []
         label_str = []
-        for n, im_file, im_labels in zip(trange(n_image), self._raw_image_files, labels):
-            im = np.array(Image.open(im_file))
 
-            def place_points_in_patches(tl_corner, br_corner, points):
-                # The slow, O(mn) way
-                for (py0, px0), (py1, px1) in zip(tl_corner, br_corner):
-                    points_in_patch = [(x - px0, y - py0) for (x, y) in points if py0 <= y < py1 and px0 <= x < px1]
-                    serial_points = [c for p in points_in_patch for c in p]  # Convert (x,y) tuples to flat x,y list
-                    new_labels.append(points_in_patch)
-                    out_labels.append(serial_points)
+        with self._autopatch_png_saver() as save_png:
+            for n, im_file, im_labels in zip(trange(n_image), self._raw_image_files, labels):
+                im = np.asarray(Image.open(im_file))
 
-            patch_start, patch_end = self._autopatch_get_patch_coords(im)
-            num_patch = len(patch_start)
-            place_points_in_patches(patch_start, patch_end, im_labels)
+                def place_points_in_patches(tl_corner, br_corner, points):
+                    # Each patch still checks every point, but as one array comparison rather than a Python loop
+                    points = np.reshape(np.asarray(points), (-1, 2))
+                    px, py = points[:, 0], points[:, 1]
+                    for (py0, px0), (py1, px1) in zip(tl_corner, br_corner):
+                        points_in_patch = points[(py0 <= py) & (py < py1) & (px0 <= px) & (px < px1)] - (px0, py0)
+                        new_labels.append([tuple(p) for p in points_in_patch.tolist()])
+                        out_labels.append(points_in_patch.ravel().tolist())  # Flat x,y list
 
-            for i, tl_coord, br_coord in zip(itertools.count(patch_num), patch_start, patch_end):
-                im_patch = Image.fromarray(self._autopatch_extract_patch(im, tl_coord, br_coord))
-                im_name = os.path.join(im_dir, 'im_{:0>6d}.png'.format(i))
-                im_patch.save(im_name)
-                image_files.append(im_name)
+                patch_start, patch_end = self._autopatch_get_patch_coords(im)
+                num_patch = len(patch_start)
+                place_points_in_patches(patch_start, patch_end, im_labels)
 
-                label_str.append('im_{:0>6d},'.format(i) + ','.join([str(x) for x in out_labels[i]]))
+                for i, tl_coord, br_coord in zip(itertools.count(patch_num), patch_start, patch_end):
+                    im_patch = Image.fromarray(self._autopatch_extract_patch(im, tl_coord, br_coord))
+                    im_name = os.path.join(im_dir, 'im_{:0>6d}.png'.format(i))
+                    save_png(im_patch, im_name)
+                    image_files.append(im_name)
 
-            patch_num += num_patch
+                    label_str.append('im_{:0>6d},'.format(i) + ','.join([str(x) for x in out_labels[i]]))
+
+                patch_num += num_patch
 
         with open(point_file, 'w') as f:
             for line in label_str:
@@ -410,7 +412,7 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
         if not self.__label_from_image_file:
             # If we generated the heatmaps from points in a CSV or JSON file, then we want to treat the labels like
             # other labels, with the wrinkle that loading them requires wrapping a binary loader with tf.py_func
-            images = self._parse_read_images(images, channels=self._image_depth)
+            images = self._parse_read_images(images, channels=self._image_depth, image_type=tf.uint8)
             labels = tf.numpy_function(self._parse_load_heatmap_binary, [labels], tf.float32)
             return images, labels
         else:
@@ -455,7 +457,7 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
 
         filter_dimension = [1, 1, copy.deepcopy(self._last_layer().output_size[3]), 1]
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.convLayer('output',
                                      copy.deepcopy(self._last_layer().output_size),
                                      filter_dimension,
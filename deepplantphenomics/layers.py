@@ -24,7 +24,15 @@ class convLayer(object):
             padding_row = padding
             padding_col = padding
 
-        self.padding = [[0, 0], [padding_row, padding_row], [padding_col, padding_col], [0, 0]]
+        # Tensorflow's named padding modes are used where they're equivalent to the explicit padding, since they give
+        # cuDNN and MKL-DNN the most freedom in picking a fast convolution algorithm (e.g. Winograd for 3x3 filters)
+        if padding_row == 0 and padding_col == 0:
+            self.padding = 'VALID'
+        elif stride_length == 1 and filter_dimension[0] % 2 == 1 and filter_dimension[1] % 2 == 1 \
+                and padding_row == filter_dimension[0] // 2 and padding_col == filter_dimension[1] // 2:
+            self.padding = 'SAME'
+        else:
+            self.padding = [[0, 0], [padding_row, padding_row], [padding_col, padding_col], [0, 0]]
         self.output_size[1] = int((self.output_size[1] - filter_dimension[0] + 2 * padding_row) / stride_length + 1)
         self.output_size[2] = int((self.output_size[2] - filter_dimension[1] + 2 * padding_col) / stride_length + 1)
         self.output_size[-1] = filter_dimension[-1]
@@ -57,14 +65,23 @@ class convLayer(object):
         return tf.assign(self.weights, self.weights * (1. - 1e-5))
 
     def forward_pass(self, x, deterministic=False):
-        activations = tf.nn.conv2d(x, self.weights,
+        weights = self.weights
+        biases = self.biases if self.use_bias else None
+
+        # In testing, batch norm is a fixed per-filter affine transform, so it gets folded into the (much smaller)
+        # weights and biases instead of taking another pass over the activations
+        fold_batch_norm = deterministic and self.batch_norm_layer is not None
+        if fold_batch_norm:
+            weights, biases = self.batch_norm_layer.fold_into(weights, biases)
+
+        activations = tf.nn.conv2d(x, weights,
                                    strides=[1, self.__stride_length, self.__stride_length, 1],
                                    padding=self.padding)
 
-        if self.use_bias:
-            activations = tf.nn.bias_add(activations, self.biases)
+        if biases is not None:
+            activations = tf.nn.bias_add(activations, biases)
 
-        if self.batch_norm_layer is not None:
+        if self.batch_norm_layer is not None and not fold_batch_norm:
             activations = self.batch_norm_layer.forward_pass(activations, deterministic)
 
         # Apply a non-linearity specified by the user
@@ -342,6 +359,11 @@ class batchNormLayer(object):
         self.test_var = tf.get_variable(self.name+'_pop_var', shape=shape, initializer=ones, trainable=False)
 
     def forward_pass(self, x, deterministic):
+        # Image-shaped inputs (i.e. from convolutions) can use the fused batch norm kernel, which does the whole
+        # normalization in one op and can be fused further with the surrounding convolution and activation by Grappler
+        if x.shape.ndims == 4:
+            return self.__fused_forward_pass(x, deterministic)
+
         mean, var = tf.nn.moments(x, axes=(0, 1, 2))
 
         # deterministic = False in training, True in testing
@@ -358,6 +380,40 @@ class batchNormLayer(object):
 
         return y
 
+    def __fused_epsilon(self):
+        # fused_batch_norm raises any epsilon below cuDNN's minimum of 1.001e-5 up to it
+        return max(self.epsilon, 1.001e-5)
+
+    def __fused_forward_pass(self, x, deterministic):
+        if deterministic:
+            y, _, _ = tf.nn.fused_batch_norm(x, self.scale, self.offset, self.test_mean, self.test_var,
+                                             self.__fused_epsilon(), is_training=False, name=self.name + '_batchnorm')
+        else:
+            y, mean, var = tf.nn.fused_batch_norm(x, self.scale, self.offset, epsilon=self.__fused_epsilon(),
+                                                  is_training=True, name=self.name + '_batchnorm')
+
+            # The fused kernel gives the Bessel-corrected (n-1) batch variance, so it's scaled back to the population
+            # (n) variance that tf.nn.moments gives, keeping the moving variance the same as the unfused pass
+            n = tf.cast(tf.size(x) // tf.shape(x)[-1], var.dtype)
+            var = var * (n - 1) / n
+
+            train_mean_op = tf.assign(self.test_mean, self.test_mean * self.decay + mean * (1 - self.decay))
+            train_var_op = tf.assign(self.test_var, self.test_var * self.decay + var * (1 - self.decay))
+
+            with tf.control_dependencies([train_mean_op, train_var_op]):
+                y = tf.identity(y)
+
+        return y
+
+    def fold_into(self, weights, biases=None):
+        """Returns the weights and biases of the preceding layer with the population statistics of this layer folded in,
+        giving the same result as the deterministic forward pass without normalizing the activations separately"""
+        scale = self.scale * tf.rsqrt(self.test_var + self.__fused_epsilon())
+        if biases is None:
+            biases = tf.zeros_like(self.test_mean)
+
+        return weights * scale, (biases - self.test_mean) * scale + self.offset
+
 
 class paralConvBlock(object):
     """A block consists of two parallel convolutional layers"""
@@ -5,6 +5,7 @@ import random
 import os
 import datetime
 import json
+import functools
 
 
 def split_raw_data(images, labels, test_ratio=0, validation_ratio=0, moderation_features=None, augmentation_images=None,
@@ -117,10 +118,8 @@ def label_string_to_tensor(x, batch_size, num_outputs=-1):
 
 
 def get_dir_images(dirname):
-    dir_files = sorted([os.path.join(dirname, f) for f in os.listdir(dirname)])
-    is_file = [os.path.isfile(f) for f in dir_files]
-    is_image = [os.path.splitext(f)[1].lower() in ['.jpg', '.jpeg', '.png'] for f in dir_files]
-    return [f for (f, b1, b2) in zip(dir_files, is_file, is_image) if b1 and b2]
+    return sorted([entry.path for entry in os.scandir(dirname) if
+                   os.path.splitext(entry.name)[1].lower() in ['.jpg', '.jpeg', '.png'] and entry.is_file()])
 
 
 def read_csv_labels(file_name, column_number=False, character=','):
@@ -191,6 +190,111 @@ def read_dataset_from_directory_with_json_labels(directory_name):
     return image_paths, labels_parsed
 
 
+def read_json_bounding_boxes(file_name):
+    """
+    Reads the image names, original image sizes, and bounding boxes (as x1, x2, y1, y2 rows) from a json label file,
+    sorted by image name. The most recently parsed file is cached by name, modification time, and size so that loading
+    the same labels again doesn't reparse them, which means the box arrays are shared between calls and are made
+    read-only. Only one file is cached, so the boxes of at most one label file are kept in memory after loading.
+    """
+    stat = os.stat(file_name)
+    return _read_json_bounding_boxes(file_name, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=1)
+def _read_json_bounding_boxes(file_name, mtime_ns, size):
+    # The modification time and size are only part of the cache key, so that edited label files are read again. The
+    # size catches files rewritten within the file system's timestamp resolution, as long as their length changed.
+    entries = {}
+    with open(file_name, 'r', encoding='utf-8-sig') as f:
+        # Each image's entry is parsed and turned into boxes on its own, so only one entry's parsed json is held in
+        # memory at a time rather than the whole file's
+        for image_id, image_data in _iter_json_object_items(f):
+            image_boxes = np.array([plant['all_points_x'][0:2] + plant['all_points_y'][0:2]
+                                    for plant in image_data['plants']]).reshape(-1, 4)
+            image_boxes.flags.writeable = False
+            entries[image_id] = ((image_data['width'], image_data['height']), image_boxes)
+
+    ids = tuple(sorted(entries))
+    sizes = tuple(entries[image_id][0] for image_id in ids)
+    boxes = tuple(entries[image_id][1] for image_id in ids)
+    return ids, sizes, boxes
+
+
+def _iter_json_object_items(f, chunk_size=1 << 20):
+    """
+    Parses a file containing a single json object incrementally, yielding its (key, value) pairs in file order.
+    The file is read in chunks and each value is decoded on its own, so memory use is bounded by the largest value
+    rather than the size of the whole file.
+    :param f: A text file object positioned at the start of the json object
+    :param chunk_size: The number of characters to read from the file at a time
+    :return: A generator of the object's (key, value) pairs
+    """
+    decoder = json.JSONDecoder()
+    whitespace = ' \t\n\r'
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill(min_size):
+        # Drop the consumed part of the buffer and read at least another chunk (growing geometrically for large
+        # values, so that retrying a partial value doesn't make reading it quadratic)
+        nonlocal buf, pos, eof
+        data = f.read(max(chunk_size, min_size))
+        buf = buf[pos:] + data
+        pos = 0
+        eof = not data
+
+    def next_char():
+        # Skip whitespace and return the next character without consuming it, or '' at the end of the file
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in whitespace:
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            fill(chunk_size)
+
+    def decode():
+        # Decode the next json value, reading more of the file while it's cut off. A value ending exactly at the end
+        # of the buffer (e.g. a number) could still continue in the next chunk, so that also reads more.
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill(len(buf) - pos)
+
+    def expect(char):
+        nonlocal pos
+        found = next_char()
+        if found != char:
+            raise json.JSONDecodeError("Expecting '{0}'".format(char), buf, pos)
+        pos += 1
+
+    expect('{')
+    if next_char() == '}':
+        return
+    while True:
+        key = decode()
+        if not isinstance(key, str):
+            raise json.JSONDecodeError("Expecting property name enclosed in double quotes", buf, pos)
+        expect(':')
+        yield key, decode()
+
+        if next_char() == ',':
+            pos += 1
+        else:
+            expect('}')
+            return
+
+
 def read_csv_multi_labels_and_ids(file_name, id_column_number, character=','):
     f = open(file_name, 'r', encoding='utf-8-sig')
     labels = []
@@ -209,12 +313,19 @@ def read_csv_multi_labels_and_ids(file_name, id_column_number, character=','):
     return labels, ids
 
 
-def string_labels_to_sequential(labels):
-    unique = set([label.strip() for label in labels])
-    num_labels = range(len(unique))
-    seq_labels = dict(zip(unique, num_labels))
+def string_labels_to_sequential(labels, return_num_classes=False):
+    """
+    Maps string labels to sequential ints in order of first appearance
+    :param labels: A list of string labels
+    :param return_num_classes: Whether to also return the number of classes, which saves counting the labels again
+    :return: A list of the sequential labels, and the number of classes if return_num_classes is set
+    """
+    seq_labels = {}
+    sequential = [seq_labels.setdefault(label.strip(), len(seq_labels)) for label in labels]
 
-    return [seq_labels[label.strip()] for label in labels]
+    if return_num_classes:
+        return sequential, len(seq_labels)
+    return sequential
 
 
 def indices_to_onehot_array(idx):
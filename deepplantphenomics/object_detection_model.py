@@ -7,7 +7,10 @@ import warnings
 import copy
 import itertools
 import shutil
+import concurrent.futures
+import cv2
 from math import ceil
+from collections import deque
 from collections.abc import Sequence
 from scipy.special import expit
 from PIL import Image
@@ -18,6 +21,12 @@ class ObjectDetectionModel(DPPModel):
     _supported_loss_fns = ['yolo']
     _supported_augmentations = [definitions.AugmentationType.CONTRAST_BRIGHT]
 
+    # For a rotation of k * 90 degrees, the columns of the (x_min, x_max, y_min, y_max) offsets from the rotation centre
+    # that each rotated coordinate comes from, and the sign it picks up
+    _quarter_turn_box_maps = {1: ([2, 3, 1, 0], [1, 1, -1, -1]),  # w and h flip, x_min y_min become x_min y_max
+                              2: ([1, 0, 3, 2], [-1, -1, -1, -1]),  # w and h stay same, become x_max y_max
+                              3: ([3, 2, 0, 1], [-1, -1, 1, 1])}  # w and h flip, x_min y_min become x_max y_min
+
     def __init__(self, debug=False, load_from_saved=False, save_checkpoints=True, initialize=True, tensorboard_dir=None,
                  report_rate=100, save_dir=None):
         super().__init__(debug, load_from_saved, save_checkpoints, initialize, tensorboard_dir, report_rate, save_dir)
@@ -42,14 +51,22 @@ class ObjectDetectionModel(DPPModel):
         self._THRESH_OVERLAP = 0.3
         self._THRESH_CORRECT = 0.5
 
+        # Constants for converting YOLO outputs to image coordinates; these are also deferred until the grid and image
+        # sizes are known
+        self._decode_cx = None
+        self._decode_cy = None
+        self._decode_anchors = None
+
+        # Constants for converting box coordinates to YOLO labels, which are likewise deferred
+        self._grid_area = None
+        self._yolo_vec_size = None
+
     def set_image_dimensions(self, image_height, image_width, image_depth):
         super().set_image_dimensions(image_height, image_width, image_depth)
 
         # Generate image-scaled anchors for YOLO object detection once the image dimensions are set
         if self._RAW_ANCHORS:
-            scale_w = self._grid_w / self._image_width
-            scale_h = self._grid_h / self._image_height
-            self._ANCHORS = [(anchor[0] * scale_w, anchor[1] * scale_h) for anchor in self._RAW_ANCHORS]
+            self.__set_yolo_decode_constants()
 
     def set_yolo_parameters(self, grid_size=None, labels=None, anchors=None):
         """
@@ -96,10 +113,25 @@ class ObjectDetectionModel(DPPModel):
         self._NUM_BOXES = len(self._RAW_ANCHORS)
 
         # Scale anchors to the grid size
+        self.__set_yolo_decode_constants()
+
+    def __set_yolo_decode_constants(self):
+        """Scales the anchors to the grid size and precomputes the grid cell positions and anchor array used to convert
+        YOLO outputs to image coordinates, as well as the label size used to convert box coordinates to YOLO labels.
+        These only change with the YOLO parameters, so they shouldn't be rebuilt for every image. The scales between
+        the grid and the image aren't kept here, since crop augmentation shrinks the image size after these are set."""
         scale_w = self._grid_w / self._image_width
         scale_h = self._grid_h / self._image_height
         self._ANCHORS = [(anchor[0] * scale_w, anchor[1] * scale_h) for anchor in self._RAW_ANCHORS]
 
+        cx, cy = np.meshgrid(np.arange(self._grid_w), np.arange(self._grid_h))
+        self._decode_cx = cx.flatten()
+        self._decode_cy = cy.flatten()
+        self._decode_anchors = np.array(self._ANCHORS)
+
+        self._grid_area = self._grid_w * self._grid_h
+        self._yolo_vec_size = 1 + self._NUM_CLASSES + 4
+
     def set_yolo_thresholds(self, thresh_sig=0.6, thresh_overlap=0.3, thresh_correct=0.5):
         """Set YOLO IoU thresholds for bounding box significance (during output filtering), overlap (during non-maximal
         suppression), and correctness (for mAP calculation)"""
@@ -225,6 +257,43 @@ class ObjectDetectionModel(DPPModel):
 
         self._graph_ops['merged'] = tf.summary.merge_all(key='custom_summaries')
 
+    @staticmethod
+    def _rotate_boxes(boxes, k, x0, y0):
+        """
+        Rotates boxes counter-clockwise by k * 90 degrees about (x0, y0), to match an image patch rotated the same way.
+        Quarter turns only permute and negate coordinates, so this is a table lookup and one array op rather than
+        multiplying by sines and cosines.
+        :param boxes: An ndarray of boxes, with one row of x_min, x_max, y_min, y_max for each
+        :param k: The number of quarter turns, from 1 to 3
+        :param x0: The x coordinate of the rotation centre
+        :param y0: The y coordinate of the rotation centre
+        :return: An ndarray with the rotated boxes
+        """
+        cols, signs = ObjectDetectionModel._quarter_turn_box_maps[k]
+        centre = np.array([x0, x0, y0, y0])
+        return centre + np.array(signs) * (boxes - centre)[:, cols]
+
+    def _deserialize_label(self, im, lab):
+        """
+        Expands a serialized sparse YOLO label from the dataset into the full label for an image
+        :param im: The image Tensor for the label, which is passed through unchanged
+        :param lab: A string Tensor with the space-separated [grid_cell, x, y, w, h] values for each occupied grid cell
+        :return: The image and a [grid_area, yolo_vec_size] Tensor with its full label
+        """
+        lab = tf.cond(tf.equal(tf.rank(lab), 0),
+                      lambda: tf.reshape(lab, [1]),
+                      lambda: lab)
+        sparse_lab = tf.string_split(lab, sep=' ')
+        lab_values = tf.reshape(tf.strings.to_number(sparse_lab.values), [-1, 5])
+
+        # Labels only hold [grid_cell, x, y, w, h] for occupied grid cells, so scatter them into the full label with
+        # the object-ness and class flags set
+        cells = tf.cast(lab_values[:, 0:1], tf.int32)
+        cell_labels = tf.concat([tf.ones([tf.shape(lab_values)[0], 1 + self._NUM_CLASSES]),
+                                 lab_values[:, 1:]], axis=1)
+        lab = tf.scatter_nd(cells, cell_labels, [self._grid_area, self._yolo_vec_size])
+        return im, lab
+
     def _assemble_graph(self):
         with self._graph.as_default():
             self._log('Assembling graph...')
@@ -234,28 +303,21 @@ class ObjectDetectionModel(DPPModel):
                 self._graph_parse_data()
 
                 # For object detection, we need to also deserialize the labels before batching the datasets
-                def _deserialize_label(im, lab):
-                    lab = tf.cond(tf.equal(tf.rank(lab), 0),
-                                  lambda: tf.reshape(lab, [1]),
-                                  lambda: lab)
-                    sparse_lab = tf.string_split(lab, sep=' ')
-                    lab_values = tf.strings.to_number(sparse_lab.values)
-                    lab = tf.reshape(lab_values, [self._grid_w * self._grid_h, 5 + self._NUM_CLASSES])
-                    return im, lab
-
-                # Batch the datasets and create iterators for them
-                self._train_dataset = self._train_dataset.map(_deserialize_label, num_parallel_calls=self._num_threads)
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                self._train_dataset = self._train_dataset.map(self._deserialize_label,
+                                                              num_parallel_calls=self._num_threads)
+                train_iter = self._batch_and_iterate(self._train_dataset, drop_remainder=True)
                 if self._testing:
-                    self._test_dataset = self._test_dataset.map(_deserialize_label,
+                    self._test_dataset = self._test_dataset.map(self._deserialize_label,
                                                                 num_parallel_calls=self._num_threads)
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
-                    self._val_dataset = self._val_dataset.map(_deserialize_label, num_parallel_calls=self._num_threads)
+                    self._val_dataset = self._val_dataset.map(self._deserialize_label,
+                                                              num_parallel_calls=self._num_threads)
                     val_iter = self._batch_and_iterate(self._val_dataset)
 
                 if self._has_moderation:
-                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features)
+                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features,
+                                                             drop_remainder=True)
                     if self._testing:
                         test_mod_iter = self._batch_and_iterate(self._test_moderation_features)
                     if self._validation:
@@ -365,8 +427,7 @@ class ObjectDetectionModel(DPPModel):
             num_batches = int(np.ceil(num_test / self._batch_size))
 
             if num_batches == 0:
-                warnings.warn('Less than a batch of testing data')
-                exit()
+                raise RuntimeError('Less than a batch of testing data')
 
             # Initialize storage for the retrieved test variables
             all_y = []
@@ -415,14 +476,12 @@ class ObjectDetectionModel(DPPModel):
         confidences converted to percents
         """
 
-        def xywh_to_xyxy(x, y, w, h):
-            x_centre = np.arange(self._grid_w * self._grid_h) % self._grid_w
-            y_centre = np.arange(self._grid_w * self._grid_h) // self._grid_w
-            scale_x = self._image_width / self._grid_w
-            scale_y = self._image_height / self._grid_h
+        scale_x = self._image_width / self._grid_w
+        scale_y = self._image_height / self._grid_h
 
-            x = (x + x_centre) * scale_x
-            y = (y + y_centre) * scale_y
+        def xywh_to_xyxy(x, y, w, h):
+            x = (x + self._decode_cx) * scale_x
+            y = (y + self._decode_cy) * scale_y
             w = w * scale_x
             h = h * scale_y
 
@@ -452,16 +511,13 @@ class ObjectDetectionModel(DPPModel):
             preds = np.reshape(preds[..., 0:self._NUM_BOXES * 5], preds.shape[:-1] + (self._NUM_BOXES, 5))
 
             # Predictions are not sensible numbers, so apply sigmoids and exponentials first and then convert them
-            anchors = np.array(self._ANCHORS)
-            pred_x = expit(preds[..., 0])
-            pred_y = expit(preds[..., 1])
-            pred_w = np.exp(preds[..., 2]) * anchors[:, 0]
-            pred_h = np.exp(preds[..., 3]) * anchors[:, 1]
+            pred_xy = expit(preds[..., 0:2])
+            pred_wh = np.exp(preds[..., 2:4]) * self._decode_anchors
             pred_conf = expit(preds[..., 4])
-            pred_x1, pred_y1, pred_x2, pred_y2 = xywh_to_xyxy(pred_x.T,  # Transposes to aid broadcasting in helper
-                                                              pred_y.T,
-                                                              pred_w.T,
-                                                              pred_h.T)
+            pred_x1, pred_y1, pred_x2, pred_y2 = xywh_to_xyxy(pred_xy[..., 0].T,  # Transposes to aid broadcasting
+                                                              pred_xy[..., 1].T,
+                                                              pred_wh[..., 0].T,
+                                                              pred_wh[..., 1].T)
             preds[..., :] = np.stack([pred_x1.T,  # Transposes to restore original shape
                                       pred_y1.T,
                                       pred_x2.T,
@@ -483,50 +539,59 @@ class ObjectDetectionModel(DPPModel):
         :return: `preds` with only the significant and maximal confidence predictions remaining
         """
         # Extract the class predictions and separate the predicted boxes
-        grid_count = preds.shape[0]
         class_preds = preds[..., self._NUM_BOXES * 5:]
         preds = np.reshape(preds[..., 0:self._NUM_BOXES * 5], preds.shape[:-1] + (self._NUM_BOXES, 5))
 
-        # In each grid square, the highest confidence box is the one responsible for prediction
-        max_conf_idx = np.argmax(preds[..., 4], axis=-1)
-        responsible_boxes = [preds[i, max_conf_idx[i], :] for i in range(grid_count)]
-        preds = np.stack(responsible_boxes, axis=0)
-
-        # Eliminate insignificant predicted boxes
-        sig_mask = preds[:, 4] > self._THRESH_SIG
+        # Eliminate grid squares without a significant box first so that later steps only work on the survivors
+        sig_mask = np.max(preds[..., 4], axis=-1) > self._THRESH_SIG
         if not np.any(sig_mask):
             return None
         class_preds = class_preds[sig_mask, :]
-        preds = preds[sig_mask, :]
+        preds = preds[sig_mask, ...]
+
+        # In each grid square, the highest confidence box is the one responsible for prediction
+        max_conf_idx = np.argmax(preds[..., 4], axis=-1)
+        preds = np.take_along_axis(preds, max_conf_idx[:, np.newaxis, np.newaxis], axis=1)[:, 0, :]
+
+        # A single significant box can't overlap with anything, so there's no need to run suppression on it
+        if preds.shape[0] == 1:
+            return np.concatenate([preds, class_preds], axis=-1)
 
         # Apply non-maximal suppression (i.e. eliminate boxes that overlap with a more confidant box)
-        maximal_idx = []
-        sig_grid_count = preds.shape[0]
-        conf_order = np.argsort(preds[:, 4])
-        pair_iou = np.array([self.__compute_iou(preds[i, 0:4], preds[j, 0:4])
-                             for i in range(sig_grid_count) for j in range(sig_grid_count)])
-        pair_iou = pair_iou.reshape(sig_grid_count, sig_grid_count)
-        while len(conf_order) > 0:
-            # Take the most confidant box, then cull the list down to boxes that don't overlap with it
-            cur_grid = conf_order[-1]
-            maximal_idx.append(cur_grid)
-            non_overlap = pair_iou[cur_grid, conf_order] < self._THRESH_OVERLAP
-            if np.any(non_overlap):
-                conf_order = conf_order[non_overlap]
-                # Make sure that the most confidant box itself isn't still in the list (usually by having a self-IOU of
-                # 0.999999... when the overlap threshold is 1)
-                conf_order = conf_order[conf_order != cur_grid]
-            else:
-                break
+        maximal_idx = self.__yolo_nms(preds[:, 0:4], preds[:, 4])
 
-        # Stick things back together. maximal_idx is not sorted, but box and class predictions should still match up
-        # and the original grid order shouldn't matter for mAP calculations
+        # Stick things back together. maximal_idx is in confidence order, but box and class predictions should still
+        # match up and the original grid order shouldn't matter for mAP calculations
         class_preds = class_preds[maximal_idx, :]
         preds = preds[maximal_idx, :]
         preds = np.concatenate([preds, class_preds], axis=-1)
 
         return preds
 
+    def __yolo_nms(self, boxes, scores):
+        """
+        Performs non-maximal suppression on a set of predicted boxes using Tensorflow's NMS op. The op is added to the
+        model's graph the first time it's needed and reused afterwards, so each call is a single session run.
+
+        :param boxes: ndarray with the bounding boxes to suppress, with coords being x1, y1, x2, y2
+        :param scores: ndarray with the confidences of the bounding boxes
+        :return: ndarray with the indices of the boxes that survive suppression, in order of descending confidence
+        """
+        if 'nms' not in self._graph_ops or self._graph_ops['nms'].graph is not self._graph:
+            with self._graph.as_default():
+                self._graph_ops['nms_boxes'] = tf.placeholder(tf.float32, shape=[None, 4])
+                self._graph_ops['nms_scores'] = tf.placeholder(tf.float32, shape=[None])
+                self._graph_ops['nms_overlap'] = tf.placeholder(tf.float32, shape=[])
+                self._graph_ops['nms'] = tf.image.non_max_suppression(self._graph_ops['nms_boxes'],
+                                                                      self._graph_ops['nms_scores'],
+                                                                      tf.shape(self._graph_ops['nms_boxes'])[0],
+                                                                      iou_threshold=self._graph_ops['nms_overlap'])
+
+        return self._session.run(self._graph_ops['nms'],
+                                 feed_dict={self._graph_ops['nms_boxes']: boxes,
+                                            self._graph_ops['nms_scores']: scores,
+                                            self._graph_ops['nms_overlap']: self._THRESH_OVERLAP})
+
     def __yolo_map(self, labels, preds):
         """
         Calculates the mean average precision of Yolo object and class predictions
@@ -557,12 +622,12 @@ class ObjectDetectionModel(DPPModel):
 
             # Calculate the IoUs of all the prediction and label pairings, then record each detection as a true or
             # false positive with the prediction confidence
-            pair_ious = np.array([self.__compute_iou(im_pred[i, 0:4], im_lab[j, 2:6])
-                                  for i in range(n_pred) for j in range(n_lab)])
-            pair_ious = np.reshape(pair_ious, (n_pred, n_lab))
+            pair_ious = self.__compute_iou(im_pred[:, np.newaxis, 0:4], im_lab[np.newaxis, :, 2:6])
+            best_lab = np.argmax(pair_ious, axis=1)
+            best_iou = pair_ious[np.arange(n_pred), best_lab]
             for i in range(n_pred):
-                j = np.argmax(pair_ious[i, :])
-                if pair_ious[i, j] >= self._THRESH_CORRECT and not im_lab[j, 6]:
+                j = best_lab[i]
+                if best_iou[i] >= self._THRESH_CORRECT and not im_lab[j, 6]:
                     detections.append((im_pred[i, 4], 1))
                     im_lab[j, 6] = 1
                 else:
@@ -600,7 +665,7 @@ class ObjectDetectionModel(DPPModel):
                 num_batches += 1
 
             self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
+            im_data = self._all_images.batch(self._batch_size).prefetch(tf.data.experimental.AUTOTUNE)
             x_test = im_data.make_one_shot_iterator().get_next()
 
             if self._with_patching:
@@ -613,21 +678,21 @@ class ObjectDetectionModel(DPPModel):
                 final_height = num_patch_rows * patch_height
                 final_width = num_patch_cols * patch_width
 
+                # Standardize the whole images, rather than each patch on its own, so that the patches (including
+                # padded ones at the edges) are scaled the same as the rest of their image
+                if self._supports_standardization:
+                    x_test = self._graph_standardize_images(x_test)
+
                 # Apply any padding to the images if, then extract the patches. Padding is only added to the bottom and
                 # right sides.
                 x_test = tf.image.pad_to_bounding_box(x_test, 0, 0, final_height, final_width)
-                sizes = [1, patch_height, patch_width, 1]
-                strides = [1, patch_height, patch_width, 1]  # Same as sizes in order to tightly tile patches
-                rates = [1, 1, 1, 1]
-                x_test = tf.image.extract_image_patches(x_test, sizes=sizes, strides=strides, rates=rates,
-                                                        padding="VALID")
-                x_test = tf.reshape(x_test, shape=[-1, patch_height, patch_width, self._image_depth])
+                x_test = self._graph_tile_patches(x_test, num_patch_rows, num_patch_cols)
 
             if self._load_from_saved:
                 self.load_state()
 
             # Run model on them
-            x_pred = self.forward_pass(x_test, deterministic=True)
+            x_pred = self.forward_pass(x_test, deterministic=True, standardize=not self._with_patching)
 
             if self._with_patching:
                 xx_output_size = [-1, num_patch_rows * num_patch_cols,
@@ -639,11 +704,8 @@ class ObjectDetectionModel(DPPModel):
             total_outputs = []
             for i in range(int(num_batches)):
                 xx = self._session.run(x_pred)
-                xx = np.reshape(xx, xx_output_size)
-                for img in np.array_split(xx, self._batch_size):
-                    total_outputs.append(img)
+                total_outputs.append(np.reshape(xx, xx_output_size))
 
-            # Delete the weird first row and any outputs which are overruns from the last batch
             total_outputs = np.concatenate(total_outputs, axis=0)
 
         return total_outputs
@@ -678,22 +740,30 @@ class ObjectDetectionModel(DPPModel):
         """
         Need to somehow merge with the iou helper function in the yolo cost function.
 
-        :param box1: x1, y1, x2, y2
-        :param box2: x1, y1, x2, y2
+        The coords are taken from the last axis and everything else is broadcast, so passing boxes with shapes (N, 1, 4)
+        and (1, M, 4) gives an (N, M) array of the IoUs of every pairing.
+
+        :param box1: ndarray with coords x1, y1, x2, y2 in the last axis
+        :param box2: ndarray with coords x1, y1, x2, y2 in the last axis
         :return: Intersection Over Union of box1 and box2
         """
-        x1 = np.maximum(box1[0], box2[0])
-        y1 = np.maximum(box1[1], box2[1])
-        x2 = np.minimum(box1[2], box2[2])
-        y2 = np.minimum(box1[3], box2[3])
-
-        intersection_area = np.maximum(0., x2 - x1) * np.maximum(0., y2 - y1)
-        union_area = \
-            ((box1[2] - box1[0]) * (box1[3] - box1[1])) + \
-            ((box2[2] - box2[0]) * (box2[3] - box2[1])) - \
-            intersection_area
-
-        return intersection_area / union_area
+        # The pairwise arrays are the big ones, so reuse them with in-place ops rather than allocating temporaries
+        inter_w = np.asarray(np.minimum(box1[..., 2], box2[..., 2], dtype=np.float64))
+        inter_w -= np.maximum(box1[..., 0], box2[..., 0])
+        np.maximum(inter_w, 0., out=inter_w)
+        inter_h = np.asarray(np.minimum(box1[..., 3], box2[..., 3], dtype=np.float64))
+        inter_h -= np.maximum(box1[..., 1], box2[..., 1])
+        np.maximum(inter_h, 0., out=inter_h)
+        intersection_area = inter_w
+        intersection_area *= inter_h
+
+        union_area = inter_h
+        np.add((box1[..., 2] - box1[..., 0]) * (box1[..., 3] - box1[..., 1]),
+               (box2[..., 2] - box2[..., 0]) * (box2[..., 3] - box2[..., 1]), out=union_area)
+        union_area -= intersection_area
+
+        intersection_area /= union_area
+        return intersection_area
 
     def add_output_layer(self, regularization_coefficient=None, output_size=None):
         if len(self._layers) < 1:
@@ -711,7 +781,7 @@ class ObjectDetectionModel(DPPModel):
                             copy.deepcopy(self._last_layer().output_size[3]),
                             (5 * self._NUM_BOXES + self._NUM_CLASSES)]
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.convLayer('output',
                                      copy.deepcopy(self._last_layer().output_size),
                                      filter_dimension,
@@ -729,60 +799,26 @@ class ObjectDetectionModel(DPPModel):
         """
         self._resize_bbox_coords = True
 
-        images = [os.path.join(dirname, name) for name in sorted(os.listdir(dirname)) if
-                  os.path.isfile(os.path.join(dirname, name)) & name.endswith('_rgb.png')]
+        images = sorted([entry.path for entry in os.scandir(dirname) if
+                          entry.name.endswith('_rgb.png') and entry.is_file()])
 
-        label_files = [os.path.join(dirname, name) for name in sorted(os.listdir(dirname)) if
-                       os.path.isfile(os.path.join(dirname, name)) & name.endswith('_bbox.csv')]
+        label_files = sorted([entry.path for entry in os.scandir(dirname) if
+                               entry.name.endswith('_bbox.csv') and entry.is_file()])
 
         # currently reads columns, need to read rows instead!!!
         labels = [loaders.read_csv_rows(label_file) for label_file in label_files]
 
-        self._all_labels = []
-        for label in labels:
-            curr_label = []
-            for nums in label:
-                # yolo wants x,y,w,h for coords
-                curr_label.extend(loaders.box_coordinates_to_xywh_coordinates(nums))
-            self._all_labels.append(curr_label)
+        # The boxes reference the original tray images, so scale them from that size down to the YOLO grid
+        image_width = self._image_width_original if self._image_width_original is not None else self._image_width
+        image_height = self._image_height_original if self._image_height_original is not None else self._image_height
+        scale_ratio_w = self._grid_w / image_width
+        scale_ratio_h = self._grid_h / image_height
 
-        self._total_raw_samples = len(images)
+        # boxes are given as c1x,c1y,...,c4x,c4y with c1 and c3 as opposite corners; yolo wants x1,x2,y1,y2 here
+        all_boxes = [[[int(nums[0]), int(nums[4]), int(nums[1]), int(nums[5])] for nums in label] for label in labels]
+        self._all_labels = self.__boxes_to_yolo_labels(all_boxes, scale_ratio_w, scale_ratio_h)
 
-        # need to add object-ness flag and one-hot encodings for class
-        # it will be 1 or 0 for object-ness, one-hot for the class, then 4 bbox coords (x,y,w,h)
-        # e.g. [1,0,0,...,1,...,0,223,364,58,62] but since there is only one class for the ippn dataset we get
-        # [1,1,x,y,w,h]
-
-        # for scaling bbox coords
-        # scaling image down to the grid size
-        scale_ratio_w = self._grid_w / self._image_width_original
-        scale_ratio_h = self._grid_h / self._image_height_original
-
-        labels_with_one_hot = []
-        for curr_img_coords in self._all_labels:
-            curr_img_labels = []
-            num_boxes = len(curr_img_coords) // 4
-            for i in range(num_boxes):
-                # start the current box label with the object-ness flag and class label (there is only one class
-                # for ippn)
-                curr_box = [1, 1]
-                # add scaled bbox coords
-                j = i * 4
-                # x and y offsets from grid position
-                x_grid = curr_img_coords[j] * scale_ratio_w
-                y_grid = curr_img_coords[j + 1] * scale_ratio_h
-                x_grid_offset, x_grid_loc = np.modf(x_grid)
-                y_grid_offset, y_grid_loc = np.modf(y_grid)
-                # w and h ratios from anchor box
-                w_ratio = curr_img_coords[j + 2] / self._ANCHORS[0]
-                h_ratio = curr_img_coords[j + 3] / self._ANCHORS[1]
-                curr_box.append(x_grid_offset)
-                curr_box.append(y_grid_offset)
-                curr_box.append(w_ratio)
-                curr_box.append(h_ratio)
-                curr_img_labels.extend(curr_box)
-            labels_with_one_hot.append(curr_img_labels)
-        self._raw_labels = labels_with_one_hot
+        self._total_raw_samples = len(images)
 
         self._log('Total raw examples is %d' % self._total_raw_samples)
         self._log('Parsing dataset...')
@@ -830,7 +866,8 @@ class ObjectDetectionModel(DPPModel):
         img_dir = os.path.join(patch_dir, 'image_patches', '')
         json_file = os.path.join(patch_dir, 'train_patches.json')
 
-        if os.path.exists(patch_dir) and not self._gen_data_overwrite:
+        # The JSON file is only put in place once every patch is done, so a patching run that was interrupted is redone
+        if os.path.exists(json_file) and not self._gen_data_overwrite:
             # If there already is a patched dataset, just load it
             self._log("Loading preexisting patched data from " + patch_dir)
             self._json_no_convert = True
@@ -847,20 +884,45 @@ class ObjectDetectionModel(DPPModel):
         os.makedirs(patch_dir)
         os.makedirs(img_dir)
 
-        # We need to construct a patched dataset, but we'll be picking them out with various methods
-        img_dict = {}
+        # We need to construct a patched dataset, but we'll be picking them out with various methods. The patch labels
+        # are streamed into the JSON file as we go instead of building up a dict of them for one big dump at the end.
+        # They go into a temporary file that only replaces the real one when it's complete.
+        json_tmp_file = json_file + '.tmp'
         new_raw_image_files = []
         new_raw_labels = []
 
+        # Use a generator seeded from the global NumPy state, so that set_random_seed still makes patching reproducible
+        rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+
+        # Encoding and writing the patch PNGs is the slowest part of patching and OpenCV releases the GIL while doing
+        # it, so the saving is handed off to a thread pool while patches keep being picked out (and numbered) in order.
+        # Patches are views into their whole source image, so only a few saves are let queue up at a time.
+        save_jobs = deque()
+
+        def save_patch(patch, patch_name):
+            # OpenCV wants BGR(A) images. A low PNG compression level keeps the patches lossless but encodes them
+            # several times faster than the default level. Patches sliced straight out of an image can be read in place
+            # since their rows are contiguous, so only flipped and rotated views need to be copied first.
+            patch = patch.astype(np.uint8, copy=False)
+            if patch.strides[0] < 0 or not patch[0].flags['C_CONTIGUOUS']:
+                patch = np.ascontiguousarray(patch)
+            if patch.ndim == 3 and patch.shape[2] == 3:
+                patch = cv2.cvtColor(patch, cv2.COLOR_RGB2BGR)
+            elif patch.ndim == 3 and patch.shape[2] == 4:
+                patch = cv2.cvtColor(patch, cv2.COLOR_RGBA2BGRA)
+            if not cv2.imwrite(patch_name, patch, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+                raise RuntimeError("Could not write image patch " + patch_name)
+
         def add_patch_to_dataset(patch, file_boxes, raw_boxes, patch_idx):
             patch_name = os.path.join(img_dir + "{:0>6d}.png".format(patch_idx))
-            patch_img = Image.fromarray(patch.astype(np.uint8))
-            patch_img.save(patch_name)
-
-            img_dict["{:0>6d}".format(patch_idx)] = {"height": self._patch_height,
-                                                     "width": self._patch_width,
-                                                     "file_name": "{:0>6d}.png".format(patch_idx),
-                                                     "plants": file_boxes}
+            self._submit_bounded(save_pool, save_jobs, save_patch, patch, patch_name)
+
+            patch_entry = {"height": self._patch_height,
+                           "width": self._patch_width,
+                           "file_name": "{:0>6d}.png".format(patch_idx),
+                           "plants": file_boxes}
+            separator = ', ' if patch_idx > 0 else ''
+            json_out.write('{0}"{1:0>6d}": {2}'.format(separator, patch_idx, json.dumps(patch_entry)))
             new_raw_image_files.append(patch_name)
             new_raw_labels.append(raw_boxes)
 
@@ -871,12 +933,13 @@ class ObjectDetectionModel(DPPModel):
             right = left + width
             return [top, bottom, left, right]
 
-        def xyxy_to_xywh_coords(x1, x2, y1, y2):
-            bw = x2 - x1
-            bh = y2 - y1
-            x = x1 + bw // 2
-            y = y1 + bh // 2
-            return [x, y, bw, bh]
+        def xyxy_to_xywh_coords(boxes):
+            boxes = np.reshape(np.asarray(boxes), (-1, 4))
+            bw = boxes[:, 1] - boxes[:, 0]
+            bh = boxes[:, 3] - boxes[:, 2]
+            x = boxes[:, 0] + bw // 2
+            y = boxes[:, 2] + bh // 2
+            return np.stack([x, y, bw, bh], axis=1)
 
         def image_to_patch_xy(xi, yi, xp, yp, p_width, p_height):
             dx = xi - xp
@@ -890,197 +953,180 @@ class ObjectDetectionModel(DPPModel):
             min_width, max_width = px_centre, orig_img.shape[1] - px_centre
             min_height, max_height = py_centre, orig_img.shape[0] - py_centre
 
-            rand_x = np.random.randint(min_width, max_width + 1)
-            rand_y = np.random.randint(min_height, max_height + 1)
+            rand_x, rand_y = rng.integers([min_width, min_height], [max_width + 1, max_height + 1])
             top, bot, left, right = xywh_to_tblr_coords(rand_x, rand_y, p_width, p_height)
             patch = orig_img[top:bot, left:right]
 
             return patch, [top, bot, left, right]
 
-        def get_boxes_in_patch(p_tblr, boxes):
+        def get_boxes_in_patch(p_tblr, boxes_xywh, x_order):
+            # Works on all of an image's boxes at once, with boxes_xywh computed once per image by xyxy_to_xywh_coords
+            # and x_order as the argsort of their x centres. Binary searching the sorted centres picks out the boxes in
+            # the patch's columns without scanning every box, and those are put back in their original order.
             p_top, p_bot, p_left, p_right = p_tblr
             p_width, p_height = (p_right - p_left), (p_bot - p_top)
-            patch_boxes = []
-            for orig_box in boxes:
-                orig_x, orig_y, orig_w, orig_h = xyxy_to_xywh_coords(*orig_box)
-                if p_left <= orig_x <= p_right and p_top <= orig_y <= p_bot:
-                    cx, cy = p_left + p_width // 2, p_top + p_height // 2
-                    patch_x, patch_y = image_to_patch_xy(orig_x, orig_y, cx, cy, p_width, p_height)
-                    patch_y_min, patch_y_max, patch_x_min, patch_x_max = xywh_to_tblr_coords(patch_x, patch_y,
-                                                                                             orig_w, orig_h)
-                    patch_boxes.append([patch_x_min, patch_x_max, patch_y_min, patch_y_max])
-
-            return patch_boxes
+            sorted_x = boxes_xywh[x_order, 0]
+            in_cols = np.sort(x_order[np.searchsorted(sorted_x, p_left, side='left'):
+                                      np.searchsorted(sorted_x, p_right, side='right')])
+            col_boxes = boxes_xywh[in_cols]
+            orig_x, orig_y, orig_w, orig_h = col_boxes[(p_top <= col_boxes[:, 1]) & (col_boxes[:, 1] <= p_bot)].T
+
+            cx, cy = p_left + p_width // 2, p_top + p_height // 2
+            patch_x, patch_y = image_to_patch_xy(orig_x, orig_y, cx, cy, p_width, p_height)
+            patch_y_min, patch_y_max, patch_x_min, patch_x_max = xywh_to_tblr_coords(patch_x, patch_y, orig_w, orig_h)
+
+            return np.stack([patch_x_min, patch_x_max, patch_y_min, patch_y_max], axis=1)
+
+        # The counter-clockwise rotations of the image patches themselves, which OpenCV does with a blocked transpose
+        quarter_turn_image_rotations = {1: cv2.ROTATE_90_COUNTERCLOCKWISE,
+                                        2: cv2.ROTATE_180,
+                                        3: cv2.ROTATE_90_CLOCKWISE}
+
+        def boxes_to_json_boxes(raw_boxes):
+            return [{"all_points_x": box[0:2], "all_points_y": box[2:4]} for box in raw_boxes]
+
+        def add_augmented_patch(img, boxes_xywh, x_order, patch_idx, aug_num):
+            # Randomly grab a patch of the image and make sure it has at least one plant in it
+            new_boxes = np.empty((0, 4))
+            while new_boxes.shape[0] == 0:
+                img_patch, img_tblr = get_random_patch(img, self._patch_width, self._patch_height)
+                new_boxes = get_boxes_in_patch(img_tblr, boxes_xywh, x_order)
+
+            # Apply one of three randomly chosen augmentations, using the choices drawn for this augmentation patch
+            aug = aug_types[aug_num]  # 1 == rotation, 2 == brightness, 3 == flip
+            if aug == 1:  # rotation
+                k = aug_turns[aug_num]
+                rot_img_patch = cv2.rotate(img_patch, quarter_turn_image_rotations[k])
+                raw_rot_boxes = self._rotate_boxes(new_boxes, k,
+                                                   self._patch_width // 2, self._patch_height // 2).tolist()
+
+                # Save patch to disk and store labels
+                add_patch_to_dataset(rot_img_patch, boxes_to_json_boxes(raw_rot_boxes), raw_rot_boxes, patch_idx)
+            elif aug == 2:  # brightness
+                value = aug_values[aug_num]
+                k = aug_coins[aug_num]
+                # OpenCV's saturating add and subtract clamp at 255 and 0 in one pass. The value has to be given as a
+                # full array, since a plain scalar would only be applied to the first channel.
+                if k < 0.5:  # brighter
+                    bright_img_patch = cv2.add(img_patch, np.full_like(img_patch, value))
+                else:  # dimmer
+                    bright_img_patch = cv2.subtract(img_patch, np.full_like(img_patch, value))
+
+                raw_bright_boxes = new_boxes.tolist()
+
+                # Save patch to disk and store labels
+                add_patch_to_dataset(bright_img_patch, boxes_to_json_boxes(raw_bright_boxes), raw_bright_boxes,
+                                     patch_idx)
+            else:  # flip (k == 3)
+                flip_boxes = new_boxes.copy()
+                k = aug_coins[aug_num]
+                if k < 0.5:
+                    flip_img_patch = cv2.flip(img_patch, 1)
+                    flip_boxes[:, 0] = self._patch_width - new_boxes[:, 1]
+                    flip_boxes[:, 1] = flip_boxes[:, 0] + (new_boxes[:, 1] - new_boxes[:, 0])
+                else:
+                    flip_img_patch = cv2.flip(img_patch, 0)
+                    flip_boxes[:, 2] = self._patch_height - new_boxes[:, 3]
+                    flip_boxes[:, 3] = flip_boxes[:, 2] + (new_boxes[:, 3] - new_boxes[:, 2])
+                raw_flip_boxes = flip_boxes.tolist()
+
+                # Save patch to disk and store labels
+                add_patch_to_dataset(flip_img_patch, boxes_to_json_boxes(raw_flip_boxes), raw_flip_boxes, patch_idx)
 
         num_orig_images = len(self._raw_image_files)
         img_name_idx = 0
 
-        # First set of patches: attempt to get patches such that every YOLO grid cell will see a plant at some point
-        # and learn to recognize them during training. The patches should be a small distance from the edges of the
-        # image, so plants in the patches should be about 1 patch-length away from the edges to allow shifting them
-        # into the appropriate grid cell.
-        for img_num, img_name, img_boxes in zip(range(num_orig_images), self._raw_image_files, self._all_labels):
-            img = np.array(Image.open(img_name))
-
-            for i, j in itertools.product(range(self._grid_h), range(self._grid_w)):
-                found_one = False
-                random_indices = list(range(len(img_boxes)))
-                while random_indices and not found_one:
-                    rand_idx = np.random.randint(0, len(random_indices))
-                    rand_plant_idx = random_indices.pop(rand_idx)
-                    box_x, box_y, box_w, box_h = xyxy_to_xywh_coords(*img_boxes[rand_plant_idx])
-                    if (self._patch_width + 5) < box_x < (img.shape[1] - (self._patch_width + 5)) \
-                            and (self._patch_height + 5) < box_y < (img.shape[0] - (self._patch_height + 5)):
-                        # This plant box meets our criteria, so get the center of the patch that places it in grid cell
-                        # (i, j)
+        # Convert the box lists into arrays of centres and sizes (with their order along x) once up front, rather than
+        # in each pass over the images
+        all_boxes_xywh = [xyxy_to_xywh_coords(img_boxes) for img_boxes in self._all_labels]
+        all_x_orders = [np.argsort(boxes_xywh[:, 0], kind='stable') for boxes_xywh in all_boxes_xywh]
+
+        # Draw the random choices for every augmentation patch in one go: the augmentation to apply, the number of
+        # quarter turns, the brightness change (just a 'nice amount'), and a coin flip for brighter or dimmer and for
+        # horizontal or vertical flips
+        aug_per_img = self._grid_h * self._grid_w
+        num_aug_patches = aug_per_img * num_orig_images
+        aug_types = rng.integers(1, 4, num_aug_patches)
+        aug_turns = rng.integers(1, 4, num_aug_patches)
+        aug_values = rng.integers(40, 76, num_aug_patches)
+        aug_coins = rng.random(num_aug_patches)
+
+        # Find the plants in each image that are far enough from the edges to be shifted into any grid cell for the
+        # baseline patches. This only needs the image sizes, which Pillow reads from the file headers without decoding
+        # the images, and it tells us up front how many baseline patches there will be.
+        all_eligible_plants = []
+        for img_name, boxes_xywh in zip(self._raw_image_files, all_boxes_xywh):
+            with Image.open(img_name) as img_header:
+                img_width, img_height = img_header.size
+            box_x, box_y = boxes_xywh[:, 0], boxes_xywh[:, 1]
+            all_eligible_plants.append(np.flatnonzero(
+                ((self._patch_width + 5) < box_x) & (box_x < (img_width - (self._patch_width + 5)))
+                & ((self._patch_height + 5) < box_y) & (box_y < (img_height - (self._patch_height + 5)))))
+
+        # The random patches should double the number of patches in our dataset
+        num_baseline_patches = sum(aug_per_img for eligible in all_eligible_plants if eligible.size > 0)
+        rand_patches_per_img = (num_baseline_patches + num_aug_patches) // num_orig_images
+
+        # All three sets of patches are made from each image in turn, so every image only gets decoded once
+        cell_w = self._patch_width / self._grid_w
+        cell_h = self._patch_height / self._grid_h
+        with open(json_tmp_file, 'w', encoding='utf-8') as json_out, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads) as save_pool:
+            json_out.write('{')
+            for img_num, img_name, img_boxes_xywh, img_x_order, eligible_plants in zip(
+                    range(num_orig_images), self._raw_image_files, all_boxes_xywh, all_x_orders, all_eligible_plants):
+                img = np.asarray(Image.open(img_name))
+
+                # First set of patches: attempt to get patches such that every YOLO grid cell will see a plant at
+                # some point and learn to recognize them during training. The patches should be a small distance from
+                # the edges of the image, so plants in the patches should be about 1 patch-length away from the edges
+                # to allow shifting them into the appropriate grid cell. If no plants meet this criteria, then no
+                # patches like this can be made for this image.
+                if eligible_plants.size > 0:
+                    for i, j in itertools.product(range(self._grid_h), range(self._grid_w)):
+                        # Get the center of the patch that places a random eligible plant in grid cell (i, j)
+                        plant_x, plant_y = img_boxes_xywh[rng.choice(eligible_plants), 0:2]
                         delta_x = j - self._grid_w // 2
                         delta_y = i - self._grid_h // 2
-                        new_x = int(box_x - (delta_x * (self._patch_width / self._grid_w)))
-                        new_y = int(box_y - (delta_y * (self._patch_height / self._grid_h)))
+                        new_x = int(plant_x - (delta_x * cell_w))
+                        new_y = int(plant_y - (delta_y * cell_h))
                         top_row, bot_row, left_col, right_col = xywh_to_tblr_coords(
                             new_x, new_y, self._patch_width, self._patch_height)
                         img_patch = img[top_row:bot_row, left_col:right_col]
 
-                        new_raw_boxes = get_boxes_in_patch([top_row, bot_row, left_col, right_col], img_boxes)
-                        new_boxes = []
-                        for box in new_raw_boxes:
-                            new_boxes.append({"all_points_x": box[0:2], "all_points_y": box[2:4]})
+                        new_raw_boxes = get_boxes_in_patch([top_row, bot_row, left_col, right_col],
+                                                           img_boxes_xywh, img_x_order).tolist()
 
                         # Save patch to disk and store labels
-                        add_patch_to_dataset(img_patch, new_raw_boxes, new_boxes, img_name_idx)
+                        add_patch_to_dataset(img_patch, boxes_to_json_boxes(new_raw_boxes), new_raw_boxes,
+                                             img_name_idx)
                         img_name_idx += 1
-                        found_one = True
-                if not found_one:
-                    # If this happens, then none of the plants can meet our criteria and no patches like this can be
-                    # made for this image
-                    break
-
-            self._log(str(img_num + 1) + '/' + str(len(self._all_labels)))
-        self._log('Completed baseline patches. Total images so far: ' + str(img_name_idx))
-
-        # Second set of patches: pick patches at random with some plants in them and randomly augment them with
-        # rotations, flips, and brightness adjustments
-        self._log('Creating augmentation patches...')
-        for i in range(self._grid_h * self._grid_w):
-            for img_name, img_boxes in zip(self._raw_image_files, self._all_labels):
-                img = np.array(Image.open(img_name))
-
-                # Randomly grab a patch of the image and make sure it has at least one plant in it
-                img_patch = None
-                new_boxes = []
-                while not new_boxes:
-                    img_patch, img_tblr = get_random_patch(img, self._patch_width, self._patch_height)
-                    new_boxes = get_boxes_in_patch(img_tblr, img_boxes)
-
-                # Randomly choose one of three augmentations to apply
-                aug = np.random.randint(1, 4)  # 1 == rotation, 2 == brightness, 3 == flip
-                if aug == 1:  # rotation
-                    k = np.random.randint(1, 4)
-                    rot_img_patch = np.rot90(img_patch, k)
-                    theta = np.radians(90 * k)
-                    x0 = self._patch_width // 2
-                    y0 = self._patch_height // 2
-                    rot_boxes = []
-                    raw_rot_boxes = []
-                    for box in new_boxes:
-                        rot_x_min = x0 + (box[0] - x0) * np.cos(theta) + (box[2] - y0) * np.sin(theta)
-                        rot_y_min = y0 - (box[0] - x0) * np.sin(theta) + (box[2] - y0) * np.cos(theta)
-                        w = box[1] - box[0]
-                        h = box[3] - box[2]
-                        if k == 1:  # w and h flip, x_min y_min become x_min y_max
-                            w, h = h, w
-                            rot_y_min -= h
-                        elif k == 2:  # w and h stay same, x_min y_min become x_max y_max
-                            rot_x_min -= w
-                            rot_y_min -= h
-                        else:  # w and h flip, x_min y_min become x_max y_min
-                            w, h = h, w
-                            rot_x_min -= w
-                        rot_x_max = rot_x_min + w
-                        rot_y_max = rot_y_min + h
-
-                        rot_boxes.append({"all_points_x": [rot_x_min, rot_x_max],
-                                          "all_points_y": [rot_y_min, rot_y_max]})
-                        raw_rot_boxes.append([rot_x_min, rot_x_max, rot_y_min, rot_y_max])
 
-                    # Save patch to disk and store labels
-                    add_patch_to_dataset(rot_img_patch, rot_boxes, raw_rot_boxes, img_name_idx)
+                # Second set of patches: pick patches at random with some plants in them and randomly augment them with
+                # rotations, flips, and brightness adjustments
+                for aug_num in range(img_num * aug_per_img, (img_num + 1) * aug_per_img):
+                    add_augmented_patch(img, img_boxes_xywh, img_x_order, img_name_idx, aug_num)
                     img_name_idx += 1
-                elif aug == 2:  # brightness
-                    value = np.random.randint(40, 76)  # just a 'nice amount' of brightness change
-                    k = np.random.random()
-                    if k < 0.5:  # brighter
-                        bright_img_patch = np.where((255 - img_patch) < value, 255, img_patch + value)
-                    else:  # dimmer
-                        bright_img_patch = np.where(img_patch < value, 0, img_patch - value)
-
-                    bright_boxes = []
-                    raw_bright_boxes = []
-                    for box in new_boxes:
-                        bright_boxes.append({"all_points_x": [box[0], box[1]],
-                                             "all_points_y": [box[2], box[3]]})
-                        raw_bright_boxes.append([box[0], box[1], box[2], box[3]])
 
-                    # Save patch to disk and store labels
-                    add_patch_to_dataset(bright_img_patch, bright_boxes, raw_bright_boxes, img_name_idx)
-                    img_name_idx += 1
-                else:  # flip (k == 3)
-                    flip_boxes = []
-                    raw_flip_boxes = []
-                    k = np.random.random()
-                    if k < 0.5:
-                        flip_img_patch = np.fliplr(img_patch)
-                        for box in new_boxes:
-                            w = box[1] - box[0]
-                            x_min = self._patch_width - box[1]
-                            x_max = x_min + w
-                            y_min = box[2]
-                            y_max = box[3]
-
-                            flip_boxes.append({"all_points_x": [x_min, x_max],
-                                               "all_points_y": [y_min, y_max]})
-                            raw_flip_boxes.append([x_min, x_max, y_min, y_max])
-                    else:
-                        flip_img_patch = np.flipud(img_patch)
-                        for box in new_boxes:
-                            h = box[3] - box[2]
-                            x_min = box[0]
-                            x_max = box[1]
-                            y_min = self._patch_height - box[3]
-                            y_max = y_min + h
-
-                            flip_boxes.append({"all_points_x": [x_min, x_max],
-                                               "all_points_y": [y_min, y_max]})
-                            raw_flip_boxes.append([x_min, x_max, y_min, y_max])
+                # Third set of patches: pick patches completely at random
+                for _ in range(rand_patches_per_img):
+                    img_patch, img_tblr = get_random_patch(img, self._patch_width, self._patch_height)
+                    raw_new_boxes = get_boxes_in_patch(img_tblr, img_boxes_xywh, img_x_order).tolist()
 
                     # Save patch to disk and store labels
-                    add_patch_to_dataset(flip_img_patch, flip_boxes, raw_flip_boxes, img_name_idx)
+                    add_patch_to_dataset(img_patch, boxes_to_json_boxes(raw_new_boxes), raw_new_boxes, img_name_idx)
                     img_name_idx += 1
-            self._log(str(i + 1) + '/' + str(self._grid_w * self._grid_h))
-        self._log('Completed augmentation patches. Total images so far: ' + str(img_name_idx))
-
-        # Third set of patches: pick patches completely at random so as to double the number of patches in our dataset
-        self._log('Generating random patches...')
-        rand_patches_per_img = img_name_idx // len(self._raw_image_files)
-        for img_num, img_name, img_boxes in zip(range(num_orig_images), self._raw_image_files, self._all_labels):
-            img = np.array(Image.open(img_name))
-
-            for _ in range(rand_patches_per_img):
-                img_patch, img_tblr = get_random_patch(img, self._patch_width, self._patch_height)
-                raw_new_boxes = get_boxes_in_patch(img_tblr, img_boxes)
-                new_boxes = []
-                for box in raw_new_boxes:
-                    new_boxes.append({"all_points_x": box[0:2], "all_points_y": box[2:4]})
 
-                # Save patch to disk and store labels
-                add_patch_to_dataset(img_patch, new_boxes, raw_new_boxes, img_name_idx)
-                img_name_idx += 1
+                self._log(str(img_num + 1) + '/' + str(num_orig_images))
+            self._log('Completed patches. Total images: ' + str(img_name_idx))
 
-            self._log(str(img_num + 1) + '/' + str(num_orig_images))
+            # Wait for the patches to finish saving, raising any errors from writing them
+            for job in save_jobs:
+                job.result()
 
-        # Save all of the patch labels as a JSON file before returning the patch filenames and labels
-        with open(json_file + 'train_patches.json', 'w', encoding='utf-8') as outfile:
-            json.dump(img_dict, outfile)
+            # Finish off the JSON file of patch labels before returning the patch filenames and labels
+            json_out.write('}')
+        os.replace(json_tmp_file, json_file)
 
         return new_raw_image_files, new_raw_labels
 
@@ -1095,52 +1141,9 @@ class ObjectDetectionModel(DPPModel):
         scale_ratio_w = self._grid_w / self._image_width
         scale_ratio_h = self._grid_h / self._image_height
 
-        labels_with_one_hot = []
-        for curr_img_coords in self._all_labels:
-            curr_img_grid_locs = []  # for duplicates; current hacky fix
-            curr_img_labels = np.zeros((self._grid_w * self._grid_h) * (1 + self._NUM_CLASSES + 4))
-
-            # only one object per image so no need to loop here
-            # add scaled bbox coords
-            # x and y offsets from grid position
-            w = curr_img_coords[1] - curr_img_coords[0]
-            h = curr_img_coords[3] - curr_img_coords[2]
-            x_center = (w / 2) + curr_img_coords[0]
-            y_center = (h / 2) + curr_img_coords[2]
-            x_grid = x_center * scale_ratio_w
-            y_grid = y_center * scale_ratio_h
-            x_grid_offset, x_grid_loc = np.modf(x_grid)
-            y_grid_offset, y_grid_loc = np.modf(y_grid)
-
-            # for duplicate object in grid checking
-            if (x_grid_loc, y_grid_loc) in curr_img_grid_locs:
-                continue
-            else:
-                curr_img_grid_locs.append((x_grid_loc, y_grid_loc))
-
-            # w and h values on grid scale
-            w_grid = w * scale_ratio_w
-            h_grid = h * scale_ratio_h
-
-            # compute grid-cell location
-            # grid is defined as left-right, down, left-right, down... so in a 3x3 grid the middle left cell
-            # would be 4 (or 3 when 0-indexing)
-            grid_loc = (y_grid_loc * self._grid_w) + x_grid_loc
-
-            # 1 for obj then 1 since only once class <- needs to be made more general for multiple classes
-            # should be [1,0,...,1,...,0,x,y,w,h] where 0,...,1,...,0 represents the one-hot encoding of classes
-            # maybe define a new list inside the loop, append a 1, then extend a one-hot list, then append
-            # x,y,w,h then use the in this next line below
-            # cur_box = []... vec_size = len(currbox)....
-            vec_size = (1 + self._NUM_CLASSES + 4)
-            curr_img_labels[int(grid_loc)*vec_size:(int(grid_loc)+1)*vec_size] = \
-                [1, 1, x_grid_offset, y_grid_offset, w_grid, h_grid]
-            # using extend because I had trouble with converting a list of lists to a tensor, so making it one list
-            # of all the numbers and then reshaping later when we pull y off the train shuffle batch has been the
-            # current hacky fix
-            labels_with_one_hot.append(curr_img_labels)
-
-        self._all_labels = labels_with_one_hot
+        # There is only one object per image, given as a flat list of coords
+        self._all_labels = self.__boxes_to_yolo_labels([[curr_img_coords] for curr_img_coords in self._all_labels],
+                                                       scale_ratio_w, scale_ratio_h)
 
     def load_json_labels_from_file(self, filename):
         super().load_json_labels_from_file(filename)
@@ -1158,49 +1161,55 @@ class ObjectDetectionModel(DPPModel):
         scale_ratio_w = self._grid_w / self._image_width
         scale_ratio_h = self._grid_h / self._image_height
 
-        labels_with_one_hot = []
-        for curr_img_coords in self._all_labels:
-            curr_img_grid_locs = []  # for duplicates; current hacky fix
-            curr_img_labels = np.zeros((self._grid_w * self._grid_h) * (1 + self._NUM_CLASSES + 4))
-            num_boxes = len(curr_img_coords)
-            for i in range(num_boxes):
-                # add scaled bbox coords
-                # x and y offsets from grid position
-                w = curr_img_coords[i][1] - curr_img_coords[i][0]
-                h = curr_img_coords[i][3] - curr_img_coords[i][2]
-                x_center = (w / 2) + curr_img_coords[i][0]
-                y_center = (h / 2) + curr_img_coords[i][2]
-                x_grid = x_center * scale_ratio_w
-                y_grid = y_center * scale_ratio_h
-                x_grid_offset, x_grid_loc = np.modf(x_grid)
-                y_grid_offset, y_grid_loc = np.modf(y_grid)
-
-                # for duplicate object in grid checking
-                if (x_grid_loc, y_grid_loc) in curr_img_grid_locs:
-                    continue
-                else:
-                    curr_img_grid_locs.append((x_grid_loc, y_grid_loc))
-
-                # w and h values on grid scale
-                w_grid = w * scale_ratio_w
-                h_grid = h * scale_ratio_h
-
-                # compute grid-cell location
-                # grid is defined as left-right, down, left-right, down... so in a 3x3 grid the middle left cell
-                # would be 4 (or 3 when 0-indexing)
-                grid_loc = ((y_grid_loc * self._grid_w) + x_grid_loc) % (self._grid_h * self._grid_w)
-                # the % (self._grid_h*self._grid_w) is to handle the rare case we are right on the edge and
-                # we want the last 0-indexed grid position (off by 1 error, get 49 for 7x7 grid when should have 48)
-
-                # 1 for obj then 1 since only one class <- needs to be made more general for multiple classes #
-                # should be [1,0,...,1,...,0,x,y,w,h] where 0,...,1,...,0 represents the one-hot encoding of classes
-                curr_box = [1, 1, x_grid_offset, y_grid_offset, w_grid, h_grid]
-
-                vec_size = (1 + self._NUM_CLASSES + 4)
-                curr_img_labels[int(grid_loc) * vec_size:(int(grid_loc) + 1) * vec_size] = curr_box
-                # using extend because I had trouble with converting a list of lists to a tensor, so making it one list
-                # of all the numbers and then reshaping later when we pull y off the train shuffle batch has been the
-                # current hacky fix
-            labels_with_one_hot.append(curr_img_labels)
-
-        return labels_with_one_hot
+        return self.__boxes_to_yolo_labels(self._all_labels, scale_ratio_w, scale_ratio_h)
+
+    def __boxes_to_yolo_labels(self, image_boxes, scale_ratio_w, scale_ratio_h):
+        """
+        Converts the bounding boxes for a set of images into sparse YOLO labels. The full label for an image has a
+        [1, 1, x_offset, y_offset, w, h] vector for each grid cell containing a box centre and zeros elsewhere, so only
+        the occupied cells are stored as [grid_cell, x_offset, y_offset, w, h] and the rest is filled in when labels
+        are pulled from the dataset. Box centres are scaled down to the grid size, and if several fall in the same cell
+        only the first one is kept. The boxes for every image are converted together so that the work isn't repeated
+        image by image.
+
+        :param image_boxes: List with a list of bounding boxes for each image, each with coords x1, x2, y1, y2
+        :param scale_ratio_w: The ratio of the grid width to the image width
+        :param scale_ratio_h: The ratio of the grid height to the image height
+        :return: List of ndarrays with the sparse YOLO label for each image
+        """
+        if len(image_boxes) == 0:
+            return []
+
+        grid_w = self._grid_w
+        grid_area = self._grid_area
+
+        image_boxes = [np.reshape(np.asarray(boxes, dtype=np.float64), (-1, 4)) for boxes in image_boxes]
+        boxes = np.concatenate(image_boxes)
+        box_image_idx = np.repeat(np.arange(len(image_boxes)), [b.shape[0] for b in image_boxes])
+
+        # x and y offsets from grid position, and w and h values on grid scale, which are written straight into the
+        # label values for each box
+        box_values = np.empty((boxes.shape[0], 5), dtype=np.float32)
+        scale_wh = (scale_ratio_w, scale_ratio_h)
+        box_wh = boxes[:, 1::2] - boxes[:, 0::2]
+        grid_xy = ((box_wh / 2) + boxes[:, 0::2]) * scale_wh
+        grid_xy_loc = np.floor(grid_xy)  # Box centres are never negative, so this matches modf but vectorizes better
+        np.subtract(grid_xy, grid_xy_loc, out=box_values[:, 1:3])
+        np.multiply(box_wh, scale_wh, out=box_values[:, 3:5])
+
+        # compute grid-cell location
+        # grid is defined as left-right, down, left-right, down... so in a 3x3 grid the middle left cell
+        # would be 4 (or 3 when 0-indexing)
+        grid_loc = ((grid_xy_loc[:, 1].astype(np.int64) * grid_w) + grid_xy_loc[:, 0].astype(np.int64)) % grid_area
+        # the % grid_area is to handle the rare case we are right on the edge and
+        # we want the last 0-indexed grid position (off by 1 error, get 49 for 7x7 grid when should have 48)
+        box_values[:, 0] = grid_loc
+
+        # Only keep the first box in each grid cell of each image. Sorting by image and then cell also groups each
+        # image's boxes together to be split apart.
+        _, first_idx = np.unique(box_image_idx * grid_area + grid_loc, return_index=True)
+        cells_per_image = np.bincount(box_image_idx[first_idx], minlength=len(image_boxes))
+        image_values = np.split(box_values[first_idx], np.cumsum(cells_per_image)[:-1])
+
+        # Labels are kept as one flat list of all the numbers and expanded when pulled from the dataset
+        return [values.ravel() for values in image_values]
@@ -14,6 +14,7 @@ class RegressionModel(DPPModel):
                                 definitions.AugmentationType.CROP,
                                 definitions.AugmentationType.CONTRAST_BRIGHT,
                                 definitions.AugmentationType.ROTATE]
+    _supports_input_patching = True
 
     def __init__(self, debug=False, load_from_saved=False, save_checkpoints=True, initialize=True, tensorboard_dir=None,
                  report_rate=100, save_dir=None):
@@ -68,7 +69,7 @@ class RegressionModel(DPPModel):
 
                 # Batch the datasets and create iterators for them
                 self._train_dataset = self._train_dataset.map(_deserialize_label, num_parallel_calls=self._num_threads)
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, drop_remainder=True)
                 if self._testing:
                     self._test_dataset = self._test_dataset.map(_deserialize_label,
                                                                 num_parallel_calls=self._num_threads)
@@ -78,16 +79,13 @@ class RegressionModel(DPPModel):
                     val_iter = self._batch_and_iterate(self._val_dataset)
 
                 if self._has_moderation:
-                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features)
+                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features,
+                                                             drop_remainder=True)
                     if self._testing:
                         test_mod_iter = self._batch_and_iterate(self._test_moderation_features)
                     if self._validation:
                         val_mod_iter = self._batch_and_iterate(self._val_moderation_features)
 
-                # # If we are using patching, we extract a random patch from the image here
-                # if self._with_patching:
-                #     x, offsets = self._graph_extract_patch(x)
-
             # Create an optimizer object for all of the devices
             optimizer = self._graph_make_optimizer()
 
@@ -135,12 +133,6 @@ class RegressionModel(DPPModel):
             self._graph_ops['cost'] = self._regression_loss + l2_cost
 
             # Calculate test and validation accuracy (on a single device at Tensorflow's discretion)
-            # # If using patching, we need to properly pull similar patches from the test and validation images
-            # if self._with_patching:
-            #     if self._testing:
-            #         x_test, _ = self._graph_extract_patch(x_test, offsets)
-            #     if self._validation:
-            #         x_val, _ = self._graph_extract_patch(x_val, offsets)
             if self._testing:
                 x_test, self._graph_ops['y_test'] = test_iter.get_next()
 
@@ -233,8 +225,7 @@ class RegressionModel(DPPModel):
             num_batches = int(np.ceil(self._total_testing_samples / self._batch_size))
 
             if num_batches == 0:
-                warnings.warn('Less than a batch of testing data')
-                exit()
+                raise RuntimeError('Less than a batch of testing data')
 
             all_losses = []
             all_y = []
@@ -303,7 +294,7 @@ class RegressionModel(DPPModel):
                 num_batches += 1
 
             self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
+            im_data = self._all_images.batch(self._batch_size).prefetch(tf.data.experimental.AUTOTUNE)
             x_test = im_data.make_one_shot_iterator().get_next()
 
             if self._load_from_saved:
@@ -356,7 +347,7 @@ class RegressionModel(DPPModel):
         else:
             num_out = output_size
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.fullyConnectedLayer('output', copy.deepcopy(self._last_layer().output_size), num_out,
                                                reshape, None, self._weight_initializer, regularization_coefficient)
 
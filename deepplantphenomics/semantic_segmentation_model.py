@@ -67,23 +67,20 @@ class SemanticSegmentationModel(DPPModel):
                 self._graph_parse_data()
 
                 # Batch the datasets and create iterators for them
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, drop_remainder=True)
                 if self._testing:
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
                     val_iter = self._batch_and_iterate(self._val_dataset)
 
                 if self._has_moderation:
-                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features)
+                    train_mod_iter = self._batch_and_iterate(self._train_moderation_features,
+                                                             drop_remainder=True)
                     if self._testing:
                         test_mod_iter = self._batch_and_iterate(self._test_moderation_features)
                     if self._validation:
                         val_mod_iter = self._batch_and_iterate(self._val_moderation_features)
 
-                # # If we are using patching, we extract a random patch from the image here
-                # if self._with_patching:
-                #     x, offsets = self._graph_extract_patch(x)
-
             # Create an optimizer object for all of the devices
             optimizer = self._graph_make_optimizer()
 
@@ -133,16 +130,6 @@ class SemanticSegmentationModel(DPPModel):
             self._graph_ops['cost'] = tf.reduce_sum(device_costs) / self._batch_size + l2_cost
 
             # Calculate test  and validation accuracy (on a single device at Tensorflow's discretion)
-            # # If using patching, we need to properly pull similar patches from the test and validation images (and
-            # # labels)
-            # if self._with_patching:
-            #     if self._testing:
-            #         x_test, _ = self._graph_extract_patch(x_test, offsets)
-            #         self._graph_ops['y_test'], _ = self._graph_extract_patch(self._graph_ops['y_test'], offsets)
-            #     if self._validation:
-            #         x_val, _ = self._graph_extract_patch(x_val, offsets)
-            #         self._graph_ops['y_val'], _ = self._graph_extract_patch(self._graph_ops['y_val'], offsets)
-
             if self._testing:
                 x_test, self._graph_ops['y_test'] = test_iter.get_next()
 
@@ -199,8 +186,7 @@ class SemanticSegmentationModel(DPPModel):
             num_batches = int(np.ceil(self._total_testing_samples / self._batch_size))
 
             if num_batches == 0:
-                warnings.warn('Less than a batch of testing data')
-                exit()
+                raise RuntimeError('Less than a batch of testing data')
 
             # Initialize storage for the retrieved test variables
             all_losses = []
@@ -247,7 +233,7 @@ class SemanticSegmentationModel(DPPModel):
                 num_batches += 1
 
             self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
+            im_data = self._all_images.batch(self._batch_size).prefetch(tf.data.experimental.AUTOTUNE)
             x_test = im_data.make_one_shot_iterator().get_next()
 
             if self._load_from_saved:
@@ -263,18 +249,18 @@ class SemanticSegmentationModel(DPPModel):
                 final_height = num_patch_rows * patch_height
                 final_width = num_patch_cols * patch_width
 
+                # Standardize the whole images, rather than each patch on its own, so that the patches (including
+                # padded ones at the edges) are scaled the same as the rest of their image
+                if self._supports_standardization:
+                    x_test = self._graph_standardize_images(x_test)
+
                 # Apply any padding to the images if, then extract the patches. Padding is only added to the bottom and
                 # right sides.
                 x_test = tf.image.pad_to_bounding_box(x_test, 0, 0, final_height, final_width)
-                sizes = [1, patch_height, patch_width, 1]
-                strides = [1, patch_height, patch_width, 1]  # Same as sizes in order to tightly tile patches
-                rates = [1, 1, 1, 1]
-                x_test = tf.image.extract_image_patches(x_test, sizes=sizes, strides=strides, rates=rates,
-                                                        padding="VALID")
-                x_test = tf.reshape(x_test, shape=[-1, patch_height, patch_width, self._image_depth])
+                x_test = self._graph_tile_patches(x_test, num_patch_rows, num_patch_cols)
 
             # Run model on them
-            x_pred = self.forward_pass(x_test, deterministic=True)
+            x_pred = self.forward_pass(x_test, deterministic=True, standardize=not self._with_patching)
 
             total_outputs = []
             if self._with_patching:
@@ -342,7 +328,7 @@ class SemanticSegmentationModel(DPPModel):
         else:
             filter_dimension = [1, 1, copy.deepcopy(self._last_layer().output_size[3]), self._num_seg_class]
 
-        with self._graph.as_default():
+        with self._graph_context():
             layer = layers.convLayer('output',
                                      copy.deepcopy(self._last_layer().output_size),
                                      filter_dimension,
@@ -405,24 +391,26 @@ class SemanticSegmentationModel(DPPModel):
         n_image = len(self._raw_image_files)
         image_files = []
         seg_files = []
-        for n, im_file, seg_file in zip(trange(n_image), self._raw_image_files, self._raw_labels):
-            im = np.array(Image.open(im_file))
-            seg = np.array(Image.open(seg_file))
 
-            patch_start, patch_end = self._autopatch_get_patch_coords(im)
-            num_patch = len(patch_start)
+        with self._autopatch_png_saver() as save_png:
+            for n, im_file, seg_file in zip(trange(n_image), self._raw_image_files, self._raw_labels):
+                im = np.asarray(Image.open(im_file))
+                seg = np.asarray(Image.open(seg_file))
+
+                patch_start, patch_end = self._autopatch_get_patch_coords(im)
+                num_patch = len(patch_start)
 
-            for i, tl_coord, br_coord in zip(itertools.count(patch_num), patch_start, patch_end):
-                im_patch = Image.fromarray(self._autopatch_extract_patch(im, tl_coord, br_coord))
-                seg_patch = Image.fromarray(self._autopatch_extract_patch(seg, tl_coord, br_coord))
-                im_name = os.path.join(im_dir, 'im_{:0>6d}.png'.format(i))
-                seg_name = os.path.join(seg_dir, 'seg_{:0>6d}.png'.format(i))
-                im_patch.save(im_name)
-                seg_patch.save(seg_name)
-                image_files.append(im_name)
-                seg_files.append(seg_name)
+                for i, tl_coord, br_coord in zip(itertools.count(patch_num), patch_start, patch_end):
+                    im_patch = Image.fromarray(self._autopatch_extract_patch(im, tl_coord, br_coord))
+                    seg_patch = Image.fromarray(self._autopatch_extract_patch(seg, tl_coord, br_coord))
+                    im_name = os.path.join(im_dir, 'im_{:0>6d}.png'.format(i))
+                    seg_name = os.path.join(seg_dir, 'seg_{:0>6d}.png'.format(i))
+                    save_png(im_patch, im_name)
+                    save_png(seg_patch, seg_name)
+                    image_files.append(im_name)
+                    seg_files.append(seg_name)
 
-            patch_num += num_patch
+                patch_num += num_patch
 
         return image_files, seg_files
 
@@ -477,8 +465,9 @@ class SemanticSegmentationModel(DPPModel):
     def _parse_apply_preprocessing(self, images, labels):
         # Apply pre-processing to the image labels too (which are images for semantic segmentation). If there are
         # multiples classes encoded as 0, 1, 2, ..., we want to maintain the read-in uint8 type and do a simple cast
-        # to float32 instead of a full image type conversion to prevent value scaling.
-        images = self._parse_read_images(images, channels=self._image_depth)
+        # to float32 instead of a full image type conversion to prevent value scaling. The input images themselves are
+        # left as uint8 and converted to float later in the input pipeline, like in DPPModel.
+        images = self._parse_read_images(images, channels=self._image_depth, image_type=tf.uint8)
         if self._num_seg_class > 2:
             labels = self._parse_read_images(labels, channels=1, image_type=tf.uint8)
             labels = tf.cast(labels, tf.float32)
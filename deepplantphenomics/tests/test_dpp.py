@@ -6,6 +6,7 @@ import numpy as np
 import os.path
 import random
 import tensorflow.compat.v1 as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import deepplantphenomics as dpp
 from deepplantphenomics import loaders, layers
 from deepplantphenomics.tests.mock_dpp_model import MockDPPModel
@@ -164,6 +165,44 @@ def test_force_split_shuffle(model):
     assert model._force_split_partition
 
 
+def test_set_mixed_precision(model):
+    assert model._mixed_precision is False
+    with pytest.raises(TypeError):
+        model.set_mixed_precision("True")
+    rewrite_options = model._session_config().graph_options.rewrite_options
+    assert rewrite_options.auto_mixed_precision != rewriter_config_pb2.RewriterConfig.ON
+    model.set_mixed_precision(True)
+    assert model._mixed_precision is True
+
+    # The option has to turn on the float16 rewrite in the session, not just loss scaling in the optimizer
+    rewrite_options = model._session_config().graph_options.rewrite_options
+    assert rewrite_options.auto_mixed_precision == rewriter_config_pb2.RewriterConfig.ON
+
+
+def test_set_xla_compilation(model):
+    assert model._xla_compilation is False
+    with pytest.raises(TypeError):
+        model.set_xla_compilation(1)
+    model.set_xla_compilation(True)
+    assert model._xla_compilation is True
+
+
+def test_set_cache_decoded_images(model):
+    assert model._cache_decoded_images is False
+    with pytest.raises(TypeError):
+        model.set_cache_decoded_images("True")
+    model.set_cache_decoded_images(True)
+    assert model._cache_decoded_images is True
+
+
+def test_set_cache_evaluation_images(model):
+    assert model._cache_evaluation_images is False
+    with pytest.raises(TypeError):
+        model.set_cache_evaluation_images("True")
+    model.set_cache_evaluation_images(True)
+    assert model._cache_evaluation_images is True
+
+
 def test_set_random_seed(model):
     with pytest.raises(TypeError):
         model.set_random_seed('7')
@@ -186,6 +225,7 @@ def test_set_random_seed(model):
     assert np.all(py_seq_1 == py_seq_2)
     assert np.all(np_seq_1 == np_seq_2)
     assert np.all(tf_seq_1 == tf_seq_2)
+    assert model._random_seed == 7
 
 
 def test_set_num_regression_outputs():
@@ -367,6 +407,35 @@ def test_set_optimizer(model):
     assert model._optimizer == 'sgd'
 
 
+def test_set_gradient_clipping(model):
+    assert model._gradient_clipping == 'global norm'
+    with pytest.raises(TypeError):
+        model.set_gradient_clipping(5)
+    with pytest.raises(ValueError):
+        model.set_gradient_clipping('Nico')
+    model.set_gradient_clipping('Value')
+    assert model._gradient_clipping == 'value'
+    model.set_gradient_clipping('global norm')
+    assert model._gradient_clipping == 'global norm'
+
+
+def test_set_gradient_summaries(model):
+    assert model._summarize_gradients is False
+    with pytest.raises(TypeError):
+        model.set_gradient_summaries("True")
+    model.set_gradient_summaries(True)
+    assert model._summarize_gradients is True
+
+
+def test_graph_make_optimizer(model):
+    for optimizer in model._supported_optimizers:
+        model.set_optimizer(optimizer)
+        assert isinstance(model._graph_make_optimizer(), tf.train.Optimizer)
+    model._optimizer = 'nico'
+    with pytest.raises(ValueError):
+        model._graph_make_optimizer()
+
+
 def test_set_weight_initializer(model):
     with pytest.raises(TypeError):
         model.set_weight_initializer(5)
@@ -417,6 +486,24 @@ def test_set_patch_size(model):
         model.set_patch_size(1, -1)
 
 
+def test_graph_tile_patches(model):
+    model.set_image_dimensions(6, 8, 2)
+    model.set_patch_size(3, 4)
+    images = np.arange(2 * 6 * 8 * 2, dtype=np.float32).reshape([2, 6, 8, 2])
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        patches = sess.run(model._graph_tile_patches(tf.constant(images), 2, 2))
+
+    # Patches are ordered by image, then by patch row, then by patch column
+    expected = [images[n, r * 3:(r + 1) * 3, c * 4:(c + 1) * 4] for n in range(2) for r in range(2) for c in range(2)]
+    assert np.array_equal(patches, np.stack(expected))
+
+    # Stitching the patches back together row by row, as inference does, gives back the original images
+    stitched = [np.concatenate([np.concatenate(list(row), axis=1) for row in np.split(img_patches, 2)], axis=0)
+                for img_patches in np.split(patches, 2)]
+    assert np.array_equal(np.stack(stitched), images)
+
+
 @pytest.mark.parametrize("model,bad_loss,good_loss",
                          [(dpp.ClassificationModel(), 'l2', 'softmax cross entropy'),
                           (dpp.RegressionModel(), 'softmax cross entropy', 'l2'),
@@ -659,6 +746,59 @@ def test_add_output_layer():
     assert isinstance(model3._last_layer(), dpp.layers.inputLayer)
 
 
+def test_export_quantized_model(model):
+    with pytest.raises(TypeError):
+        model.export_quantized_model(5, np.zeros((1, 1, 1, 1)))
+    with pytest.raises(TypeError):
+        model.export_quantized_model('model.tflite', [[[[0.0]]]])
+    with pytest.raises(ValueError):
+        model.export_quantized_model('model.tflite', np.zeros((1, 1, 1)))
+    with pytest.raises(ValueError):
+        model.export_quantized_model('model.tflite', np.zeros((0, 1, 1, 1)))
+
+
+def test_export_quantized_model_writes_file(tmpdir):
+    model = dpp.RegressionModel()
+    model.set_image_dimensions(8, 8, 1)
+    model.add_input_layer()
+    model.add_convolutional_layer([3, 3, 1, 2], 1, 'relu')
+    model.add_output_layer()
+    with model._graph.as_default():
+        model._add_layers_to_graph()
+        model._session.run(tf.global_variables_initializer())
+
+    filename = os.path.join(str(tmpdir), 'model.tflite')
+    model.export_quantized_model(filename, np.random.rand(4, 8, 8, 1).astype(np.float32))
+    assert os.path.getsize(filename) > 0
+
+
+def test_export_quantized_model_with_standardization(tmpdir):
+    model = dpp.SemanticSegmentationModel()
+    model.set_image_dimensions(8, 8, 1)
+    model.add_input_layer()
+    model.add_convolutional_layer([3, 3, 1, 2], 1, 'relu')
+    model.add_output_layer()
+    assert model._supports_standardization
+    with model._graph.as_default():
+        model._add_layers_to_graph()
+        model._session.run(tf.global_variables_initializer())
+
+    # The exported model starts with the in-graph standardization, which has to convert and run in Tensorflow Lite
+    filename = os.path.join(str(tmpdir), 'model.tflite')
+    images = np.random.rand(4, 8, 8, 1).astype(np.float32)
+    model.export_quantized_model(filename, images)
+
+    interpreter = tf.lite.Interpreter(model_path=filename)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    interpreter.set_tensor(input_details['index'], images[0:1])
+    interpreter.invoke()
+    output = interpreter.get_tensor(output_details['index'])
+    assert output.shape[0:3] == (1, 8, 8)
+    assert np.all(np.isfinite(output))
+
+
 # more loading data tests!!!!
 def test_load_dataset_from_directory_with_csv_labels(model, test_data_dir):
     im_path = os.path.join(test_data_dir, 'test_dir_csv_labels', '')
@@ -831,12 +971,48 @@ def test_forward_pass_residual():
 
     # Add the layers and get the forward pass
     model._add_layers_to_graph()
-    out_im = model.forward_pass(test_im)
+    out_im = model.forward_pass(test_im, standardize=False)
 
     assert out_im.size == expected_im.size
     assert np.all(out_im == expected_im)
 
 
+def test_graph_standardize_images(model):
+    images = np.random.RandomState(7).rand(2, 5, 4, 3).astype(np.float32)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        out = sess.run(model._graph_standardize_images(images))
+        expected = sess.run(tf.map_fn(tf.image.per_image_standardization, tf.constant(images)))
+    assert np.allclose(out, expected, atol=1e-5)
+
+    # Unbatched images are rejected rather than being reduced over the wrong axes
+    with pytest.raises(ValueError):
+        model._graph_standardize_images(images[0])
+
+
+def test_forward_pass_with_patching_standardizes_whole_images(test_data_dir):
+    image_file = os.path.join(test_data_dir, 'test_seg_masks', 'raws', '1.tif.png')
+
+    def get_output(patch_size):
+        model = dpp.SemanticSegmentationModel()
+        model.set_image_dimensions(10, 10, 3)
+        model.set_batch_size(1)
+        if patch_size:
+            model.set_patch_size(patch_size, patch_size)
+
+        # With only an input layer, the output is just the standardized input image
+        model.add_input_layer()
+        model._add_layers_to_graph()
+        return model.forward_pass_with_file_inputs([image_file])
+
+    # Patches (including the zero-padded ones at the edges) are scaled by their whole image, not on their own, so
+    # stitching them back together gives the same image as standardizing it without patching
+    whole_out = get_output(None)
+    patched_out = get_output(4)
+    assert patched_out.shape == whole_out.shape
+    assert np.allclose(patched_out, whole_out, atol=1e-5)
+
+
 def test_graph_problem_loss_semantic():
     model = dpp.SemanticSegmentationModel()
     assert model._loss_fn == 'sigmoid cross entropy'
@@ -981,7 +1157,7 @@ def test_det_shuffle_dataset(model, test_data_dir):
         with model._graph.as_default():
             model.set_random_seed(7)
             ds = tf.data.Dataset.from_tensor_slices(model._raw_image_files)
-            ds = model._batch_and_iterate(ds, shuffle=True)
+            ds = model._batch_and_iterate(ds.shuffle(10000))
             data_iter = ds.get_next()
 
             data = []
@@ -0,0 +1,96 @@
+import pytest
+import numpy as np
+import tensorflow.compat.v1 as tf
+from deepplantphenomics import layers
+
+
+def set_batch_norm_values(sess, bn, rng):
+    # Give the batch norm parameters and population statistics values that aren't a no-op
+    num_channels = bn.output_size[-1]
+    sess.run([tf.assign(bn.offset, rng.randn(num_channels).astype(np.float32)),
+              tf.assign(bn.scale, (rng.rand(num_channels) + 0.5).astype(np.float32)),
+              tf.assign(bn.test_mean, rng.randn(num_channels).astype(np.float32)),
+              tf.assign(bn.test_var, (rng.rand(num_channels) + 0.5).astype(np.float32))])
+
+
+@pytest.mark.parametrize("use_bias", [True, False])
+def test_conv_batch_norm_folding(use_bias):
+    rng = np.random.RandomState(7)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        layer = layers.convLayer('conv', [2, 8, 8, 3], [3, 3, 3, 4], 1, 'relu', 'normal',
+                                 batch_norm=True, use_bias=use_bias)
+        layer.add_to_graph()
+        sess.run(tf.global_variables_initializer())
+        bn = layer.batch_norm_layer
+        set_batch_norm_values(sess, bn, rng)
+
+        x = tf.constant(rng.randn(2, 8, 8, 3).astype(np.float32))
+        folded = layer.forward_pass(x, deterministic=True)
+
+        conv = tf.nn.conv2d(x, layer.weights, strides=[1, 1, 1, 1], padding=layer.padding)
+        if use_bias:
+            conv = tf.nn.bias_add(conv, layer.biases)
+        unfolded = tf.nn.relu(tf.nn.batch_normalization(conv, bn.test_mean, bn.test_var, bn.offset, bn.scale,
+                                                        bn.epsilon))
+
+        folded_out, unfolded_out = sess.run([folded, unfolded])
+        np.testing.assert_allclose(folded_out, unfolded_out, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("deterministic", [True, False])
+def test_fused_batch_norm(deterministic):
+    rng = np.random.RandomState(7)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        bn = layers.batchNormLayer('bn', [4, 6, 6, 3])
+        bn.add_to_graph()
+        sess.run(tf.global_variables_initializer())
+        set_batch_norm_values(sess, bn, rng)
+        old_mean, old_var = sess.run([bn.test_mean, bn.test_var])
+
+        x_values = rng.randn(4, 6, 6, 3).astype(np.float32)
+        x = tf.constant(x_values)
+        fused = bn.forward_pass(x, deterministic)
+
+        # The unfused batch norm normalizes with the population statistics in testing and the batch moments (with
+        # the biased variance) in training
+        if deterministic:
+            mean, var = bn.test_mean, bn.test_var
+        else:
+            mean, var = tf.nn.moments(x, axes=(0, 1, 2))
+        unfused = tf.nn.batch_normalization(x, mean, var, bn.offset, bn.scale, bn.epsilon)
+
+        fused_out, unfused_out = sess.run([fused, unfused])
+        np.testing.assert_allclose(fused_out, unfused_out, rtol=1e-4, atol=1e-5)
+
+        new_mean, new_var = sess.run([bn.test_mean, bn.test_var])
+        if deterministic:
+            np.testing.assert_array_equal(new_mean, old_mean)
+            np.testing.assert_array_equal(new_var, old_var)
+        else:
+            # The moving variance tracks the biased batch variance, like it did with tf.nn.moments
+            batch_mean = x_values.mean(axis=(0, 1, 2))
+            batch_var = x_values.var(axis=(0, 1, 2))
+            np.testing.assert_allclose(new_mean, old_mean * bn.decay + batch_mean * (1 - bn.decay), rtol=1e-4)
+            np.testing.assert_allclose(new_var, old_var * bn.decay + batch_var * (1 - bn.decay), rtol=1e-4)
+
+
+def test_conv_batch_norm_folding_small_epsilon():
+    rng = np.random.RandomState(7)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        layer = layers.convLayer('conv', [2, 8, 8, 3], [3, 3, 3, 4], 1, None, 'normal', batch_norm=True,
+                                 epsilon=1e-8)
+        layer.add_to_graph()
+        sess.run(tf.global_variables_initializer())
+        bn = layer.batch_norm_layer
+        set_batch_norm_values(sess, bn, rng)
+        # Make the population variance small enough that the clamped epsilon makes a visible difference
+        sess.run(tf.assign(bn.test_var, (rng.rand(4) * 1e-5 + 1e-6).astype(np.float32)))
+
+        x = tf.constant(rng.randn(2, 8, 8, 3).astype(np.float32) * 1e-3)
+        folded = layer.forward_pass(x, deterministic=True)
+
+        conv = tf.nn.conv2d(x, layer.weights, strides=[1, 1, 1, 1], padding=layer.padding)
+        unfolded = bn.forward_pass(conv, deterministic=True)
+
+        folded_out, unfolded_out = sess.run([folded, unfolded])
+        np.testing.assert_allclose(folded_out, unfolded_out, rtol=1e-4, atol=1e-5)
@@ -3,6 +3,8 @@ import shutil
 import pytest
 from unittest.mock import patch
 import os
+import io
+import json
 import numpy as np
 from deepplantphenomics import loaders
 
@@ -47,7 +49,52 @@ def test_read_csv_multi_labels_and_ids(csv_data, test_data_dir):
     assert ids == csv_data['labels']
 
 
-# testing string_labels_to_sequential is difficult because it uses set() which is not consistent in what it returns
+def test_string_labels_to_sequential():
+    assert loaders.string_labels_to_sequential(['b', 'a ', 'b', 'c', 'a']) == [0, 1, 0, 2, 1]
+    labels, num_classes = loaders.string_labels_to_sequential(['b', 'a ', 'b', 'c', 'a'], return_num_classes=True)
+    assert labels == [0, 1, 0, 2, 1]
+    assert num_classes == 3
+
+
+def test_read_json_bounding_boxes(tmpdir):
+    label_file = os.path.join(str(tmpdir), 'boxes.json')
+    with open(label_file, 'w') as f:
+        json.dump({'im_b': {'width': 100, 'height': 50, 'plants': []},
+                   'im_a': {'width': 200, 'height': 80, 'plants': [{'all_points_x': [1, 5], 'all_points_y': [2, 9]},
+                                                                   {'all_points_x': [3, 7], 'all_points_y': [4, 6]}]}},
+                  f)
+
+    ids, sizes, boxes = loaders.read_json_bounding_boxes(label_file)
+    assert ids == ('im_a', 'im_b')
+    assert sizes == ((200, 80), (100, 50))
+    assert np.array_equal(boxes[0], [[1, 5, 2, 9], [3, 7, 4, 6]])
+    assert boxes[1].shape == (0, 4)
+    assert not boxes[0].flags.writeable
+
+    # Reading the same, unchanged file again should reuse the cached boxes
+    assert loaders.read_json_bounding_boxes(label_file)[2] is boxes
+
+    # Rewriting the file should read it again, even if its modification time didn't change
+    mtime_ns = os.stat(label_file).st_mtime_ns
+    with open(label_file, 'w') as f:
+        json.dump({'im_c': {'width': 10, 'height': 20, 'plants': []}}, f)
+    os.utime(label_file, ns=(mtime_ns, mtime_ns))
+    assert loaders.read_json_bounding_boxes(label_file)[0] == ('im_c',)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_iter_json_object_items(chunk_size):
+    data = {'b': {'width': 12345, 'plants': [{'all_points_x': [1.5, -2e3]}]}, 'a': [], 'c': "x } y", 'd': 678}
+    text = ' \n' + json.dumps(data, indent=2) + '\n'
+
+    items = list(loaders._iter_json_object_items(io.StringIO(text), chunk_size=chunk_size))
+    assert items == list(data.items())
+
+    assert list(loaders._iter_json_object_items(io.StringIO(' { } '), chunk_size=chunk_size)) == []
+    with pytest.raises(json.JSONDecodeError):
+        list(loaders._iter_json_object_items(io.StringIO('{"a": [1, 2'), chunk_size=chunk_size))
+    with pytest.raises(json.JSONDecodeError):
+        list(loaders._iter_json_object_items(io.StringIO('[1, 2]'), chunk_size=chunk_size))
 
 
 def test_indices_to_onehot():
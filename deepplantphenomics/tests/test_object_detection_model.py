@@ -0,0 +1,78 @@
+import pytest
+import numpy as np
+import tensorflow.compat.v1 as tf
+import deepplantphenomics as dpp
+
+
+def dense_yolo_label(boxes, grid_w, grid_h, image_width, image_height):
+    # The original per-box encoding of a flat YOLO label, which keeps the first box in each grid cell
+    scale_ratio_w = grid_w / image_width
+    scale_ratio_h = grid_h / image_height
+    vec_size = 6
+    label = np.zeros(grid_w * grid_h * vec_size)
+    grid_locs = []
+    for x1, x2, y1, y2 in boxes:
+        w = x2 - x1
+        h = y2 - y1
+        x_grid_offset, x_grid_loc = np.modf(((w / 2) + x1) * scale_ratio_w)
+        y_grid_offset, y_grid_loc = np.modf(((h / 2) + y1) * scale_ratio_h)
+        if (x_grid_loc, y_grid_loc) in grid_locs:
+            continue
+        grid_locs.append((x_grid_loc, y_grid_loc))
+
+        grid_loc = int(((y_grid_loc * grid_w) + x_grid_loc) % (grid_h * grid_w))
+        label[grid_loc * vec_size:(grid_loc + 1) * vec_size] = [1, 1, x_grid_offset, y_grid_offset,
+                                                                w * scale_ratio_w, h * scale_ratio_h]
+    return label
+
+
+def test_yolo_labels_match_dense_encoding():
+    model = dpp.ObjectDetectionModel()
+    model.set_image_dimensions(448, 448, 3)
+    model.set_yolo_parameters()
+
+    image_boxes = [[],  # No boxes at all
+                   [[10, 50, 20, 60], [100, 180, 200, 300]],
+                   [[70, 90, 70, 90], [66, 120, 66, 110], [300, 400, 10, 40]]]  # The first two share a grid cell
+    sparse_labels = model._ObjectDetectionModel__boxes_to_yolo_labels(image_boxes, 7 / 448, 7 / 448)
+    assert len(sparse_labels) == len(image_boxes)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        serialized_label = tf.placeholder(tf.string, [])
+        _, label = model._deserialize_label(tf.zeros([1]), serialized_label)
+
+        for boxes, sparse_label in zip(image_boxes, sparse_labels):
+            # Labels are serialized the same way as when the dataset is split
+            full_label = sess.run(label, feed_dict={serialized_label: ' '.join(map(str, sparse_label))})
+            assert full_label.shape == (49, 6)
+            np.testing.assert_allclose(full_label.ravel(), dense_yolo_label(boxes, 7, 7, 448, 448),
+                                       rtol=1e-5, atol=1e-6)
+
+
+def rotate_box(box, k, x0, y0):
+    # The original rotation of a single (x_min, x_max, y_min, y_max) box counter-clockwise by k * 90 degrees
+    theta = np.radians(90 * k)
+    rot_x_min = x0 + (box[0] - x0) * np.cos(theta) + (box[2] - y0) * np.sin(theta)
+    rot_y_min = y0 - (box[0] - x0) * np.sin(theta) + (box[2] - y0) * np.cos(theta)
+    w = box[1] - box[0]
+    h = box[3] - box[2]
+    if k == 1:
+        w, h = h, w
+        rot_y_min -= h
+    elif k == 2:
+        rot_x_min -= w
+        rot_y_min -= h
+    else:
+        w, h = h, w
+        rot_x_min -= w
+    return [rot_x_min, rot_x_min + w, rot_y_min, rot_y_min + h]
+
+
+@pytest.mark.parametrize("k", [1, 2, 3])
+def test_rotate_boxes(k):
+    boxes = np.array([[10, 30, 5, 45], [0, 128, 0, 96], [70, 75, 60, 90]])
+    x0, y0 = 128 // 2, 96 // 2
+
+    rotated = dpp.ObjectDetectionModel._rotate_boxes(boxes, k, x0, y0)
+    expected = [rotate_box(box, k, x0, y0) for box in boxes]
+    np.testing.assert_allclose(rotated, expected, atol=1e-9)
@@ -12,7 +12,7 @@ setup(
     description='Deep learning tools for plant phenotyping',
     install_requires=[
         'tensorflow<=1.15',
-        'numpy',
+        'numpy>=1.17',
         'tqdm',
         'opencv-python',
         'scipy',